@@ -5,12 +5,13 @@ inspired by:
 
 Code generation supported by Claude
 """
+import asyncio
 import gradio as gr
 import os
-from openai import AzureOpenAI
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from dotenv import load_dotenv
 # local imports
-import utils
 import settings
 import txt_translation
 import docx_translation
@@ -19,10 +20,9 @@ import pdf_translation
 
 def list_files_in_directory(directory_path):
     try:
-        # List all files in the given directory
-        files = os.listdir(directory_path)
-        # Filter to include only files (not directories)
-        files = [file for file in files if os.path.isfile(os.path.join(directory_path, file))]
+        # List only files (not directories) in the given directory, using the cached entry type of os.scandir
+        with os.scandir(directory_path) as entries:
+            files = [entry.name for entry in entries if entry.is_file()]
         return gr.Dropdown(choices=files)
     except FileNotFoundError:
         return gr.Dropdown(choices=["Folder not found. Please enter a valid path."])
@@ -30,68 +30,98 @@ def list_files_in_directory(directory_path):
         return gr.Dropdown(choices=[str(e)])
 
 
-def process_translation(file_list, input_folder, target_language, save_as_pdf, progress=gr.Progress()):
+async def translate_file(file_name, input_folder, target_language, save_as_pdf, output_folder):
     """
-    Main processing function
+    Translate a single file, dispatching on its file extension
+    """
+    file_path = os.path.join(input_folder, file_name)
+    file_extension = os.path.splitext(file_path)[1].lower()
+    if file_extension == ".txt":
+        await txt_translation.translate_txt_document(client=async_client,
+                                                     model=AZURE_DEPLOYMENT_NAME,
+                                                     input_path=file_path,
+                                                     target_language=target_language,
+                                                     output_folder=output_folder,
+                                                     save_as_pdf=save_as_pdf,
+                                                     use_batch_api=BATCH_MODE)
+    elif file_extension == ".docx":
+        await docx_translation.translate_docx_document(client=async_client,
+                                                       model=AZURE_DEPLOYMENT_NAME,
+                                                       input_path=file_path,
+                                                       target_language=target_language,
+                                                       output_folder=output_folder,
+                                                       save_as_pdf=save_as_pdf)
+    elif file_extension == ".pdf":
+        await pdf_translation.translate_pdf_document(client=async_client,
+                                                     model=AZURE_DEPLOYMENT_NAME,
+                                                     input_path=file_path,
+                                                     target_language=target_language,
+                                                     output_path=output_folder,
+                                                     use_batch_api=BATCH_MODE)
+
+
+async def translate_and_report(file_number, file_name, number_of_files, queue, semaphore, **kwargs):
+    """
+    Translate a single file and report on the queue when its translation starts and finishes
+    """
+    try:
+        async with semaphore:
+            await queue.put((False, f"Translating file {file_number}/{number_of_files}: {file_name}"))
+            await translate_file(file_name=file_name, **kwargs)
+        await queue.put((True, f"Translation completed for {file_name}.\n"))
+    except Exception as e:
+        await queue.put((True, f"Processing error for {file_name}: {str(e)}\n"))
+        raise
+
+
+async def process_translation(file_list, input_folder, target_language, save_as_pdf, progress=gr.Progress()):
+    """
+    Main processing function, translates the selected files concurrently
     """
-    status_text = ""
-    
     if file_list is None:
-        return "Please select one or more files first.", None
+        yield "Please select one or more files first."
+        return
     
     if not target_language:
-        return "Please select a target language.", None
+        yield "Please select a target language."
+        return
     
     try:
-        # if watermark file doesn't exist yet, create it
-        if not os.path.exists("watermark.pdf"):
-            utils.create_watermark("generated with PBL translator", "watermark.pdf")
-        
         # if output folder doesn't exist yet, create it
         output_folder = os.path.join(input_folder, "translations")
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
 
-        # translation loop over all selected files
-        for i, file_name in enumerate(file_list):
-            print(i, file_name)
-            file_path = os.path.join(input_folder, file_name)
-            file_extension = os.path.splitext(file_path)[1].lower()
-            status_message = f"Translating file {i+1}/{len(file_list)}: {file_name}"
+        # every file is translated in its own task, reporting (finished, status message) tuples on a queue
+        queue = asyncio.Queue()
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+        tasks = [asyncio.create_task(translate_and_report(file_number=i+1,
+                                                          file_name=file_name,
+                                                          number_of_files=len(file_list),
+                                                          queue=queue,
+                                                          semaphore=semaphore,
+                                                          input_folder=input_folder,
+                                                          target_language=target_language,
+                                                          save_as_pdf=save_as_pdf,
+                                                          output_folder=output_folder))
+                 for i, file_name in enumerate(file_list)]
+
+        # pass on status messages in the order in which they occur, until all files are finished
+        pending = len(tasks)
+        while pending:
+            finished, status_message = await queue.get()
+            pending -= finished
             print(status_message)
-            progress(i/len(file_list), desc=status_message)
+            progress((len(tasks) - pending)/len(tasks), desc=status_message)
             yield status_message
-
-            if file_extension == ".txt":
-                txt_translation.translate_txt_document(client=client,
-                                                       model=AZURE_DEPLOYMENT_NAME,
-                                                       input_path=file_path,
-                                                       target_language=target_language,
-                                                       output_folder=output_folder,
-                                                       save_as_pdf=save_as_pdf)
-            elif file_extension == ".docx":
-                # print(f"Translating Word document: {file_name} to {target_language}")
-                docx_translation.translate_docx_document(client=client,
-                                                         model=AZURE_DEPLOYMENT_NAME,
-                                                         input_path=file_path,
-                                                         target_language=target_language,
-                                                         output_folder=output_folder,
-                                                         save_as_pdf=save_as_pdf)
-            elif file_extension == ".pdf":
-                # print(f"Translating PDF document: {file_name} to {target_language}")
-                pdf_translation.translate_pdf_document(client=client,
-                                                       model=AZURE_DEPLOYMENT_NAME,
-                                                       input_path=file_path,
-                                                       target_language=target_language,
-                                                       output_path=output_folder)
-            completed_message = f"Translation completed for {file_name}.\n"
-            yield completed_message
+        # raise the error of a failed file, if any
+        await asyncio.gather(*tasks)
 
         final_message = f"Done!, all files successfully translated to {target_language}."
         yield final_message
     
     except Exception as e:
-        return f"Processing error: {str(e)}", None
+        yield f"Processing error: {str(e)}"
 
 
 # load Azure OpenAI api key
@@ -102,15 +132,39 @@ AZURE_OPENAI_ENDPOINT = settings.AZURE_OPENAI_ENDPOINT
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_VERSION = settings.AZURE_OPENAI_API_VERSION
 AZURE_DEPLOYMENT_NAME = settings.AZURE_DEPLOYMENT_NAME
+# Translate with the Batch API, off for settings files copied from a template without BATCH_MODE
+BATCH_MODE = getattr(settings, "BATCH_MODE", False)
+
+# Connection pool limits of the HTTP clients, connections are kept alive across documents so TLS sessions are reused.
+# Settings files copied from a template without HTTP_MAX_CONNECTIONS use the default of the template
+HTTP_MAX_CONNECTIONS = getattr(settings, "HTTP_MAX_CONNECTIONS", 128)
+HTTP_LIMITS = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                           max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                           keepalive_expiry=300.0)
 
 # Initialize Azure OpenAI client
 client = AzureOpenAI(
     azure_endpoint=AZURE_OPENAI_ENDPOINT,
     api_key=AZURE_OPENAI_API_KEY,
     api_version=AZURE_OPENAI_VERSION,
-    azure_deployment=AZURE_DEPLOYMENT_NAME
+    azure_deployment=AZURE_DEPLOYMENT_NAME,
+    http_client=httpx.Client(limits=HTTP_LIMITS)
+)
+
+# Initialize async Azure OpenAI client, used for concurrent translation of files
+# Rate limited requests (429) are retried by the client with exponential backoff
+async_client = AsyncAzureOpenAI(
+    azure_endpoint=AZURE_OPENAI_ENDPOINT,
+    api_key=AZURE_OPENAI_API_KEY,
+    api_version=AZURE_OPENAI_VERSION,
+    azure_deployment=AZURE_DEPLOYMENT_NAME,
+    max_retries=5,
+    http_client=httpx.AsyncClient(limits=HTTP_LIMITS)
 )
 
+# Maximum number of files that are translated at the same time
+MAX_CONCURRENT_FILES = 8
+
 # Language options
 LANGUAGES = [
     "Dutch", "German", "English", "Spanish", "French", "Italian", "Portuguese", 
@@ -0,0 +1,64 @@
+"""
+Azure OpenAI Batch API support
+
+Translation requests of a document are submitted together as a single batch job instead of
+separate chat completions. Batch jobs cost about half as much and do not count against the
+requests per minute of the deployment, at the cost of a turnaround time of up to 24 hours.
+The model of the requests must be a deployment of type "Global Batch".
+
+"""
+import asyncio
+from typing import Dict
+import orjson
+from openai import AsyncAzureOpenAI
+
+# Number of seconds between two status checks of a batch job
+POLL_INTERVAL = 30
+# Statuses of a batch job that has stopped running
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+async def run_batch(client: AsyncAzureOpenAI, requests: Dict[str, dict]) -> Dict[str, str]:
+    """
+    Submit chat completion requests as one batch job and wait until the job has finished.
+
+    Args:
+        client: Async Azure OpenAI client
+        requests: Dictionary of custom id to chat completion request body (model, messages, ...)
+
+    Returns:
+        Dictionary of custom id to the message content of the response, for every successful request.
+        A response that was cut off at the maximum number of output tokens is left out like a failed request.
+    """
+    lines = [orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": body})
+             for custom_id, body in requests.items()]
+    batch_file = await client.files.create(file=("batch.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = await client.batches.create(input_file_id=batch_file.id,
+                                        endpoint="/chat/completions",
+                                        completion_window="24h")
+    print(f"Submitted batch job {batch.id} with {len(requests)} requests")
+
+    while batch.status not in FINAL_STATUSES:
+        await asyncio.sleep(POLL_INTERVAL)
+        batch = await client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch job {batch.id} ended with status {batch.status}")
+
+    results = {}
+    if batch.output_file_id:
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            response = result.get("response")
+            if response and response.get("status_code") == 200:
+                choice = response["body"]["choices"][0]
+                if choice.get("finish_reason") == "length":
+                    print(f"Response {result['custom_id']} was cut off at the maximum number of output tokens")
+                    continue
+                results[result["custom_id"]] = choice["message"]["content"]
+    print(f"Batch job {batch.id} completed, {len(results)}/{len(requests)} requests succeeded")
+
+    return results
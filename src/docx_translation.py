@@ -6,99 +6,130 @@ while preserving all formatting, fonts, and layout, then outputs a new translate
 
 """
 import os
-import time
+import asyncio
+import itertools
+from collections import namedtuple
 from typing import List
+import orjson
 from docx import Document
-from openai import AzureOpenAI
+from docx.oxml.ns import qn
+from docx.text.run import Run
+from openai import AsyncAzureOpenAI
 # local imports
 import utils
 
+# Maximum number of API calls in flight at the same time per document
+MAX_CONCURRENT_REQUESTS = 8
+# Qualified tag name of a run element in WordprocessingML
+_W_R = qn('w:r')
+# Run formatting that is carried over to the translated text, None means "not set"
+RunFormat = namedtuple('RunFormat', 'bold italic underline name size color highlight')
+_EMPTY_RUN_FORMAT = RunFormat(None, None, None, None, None, None, None)
+# Attribute that holds each RunFormat field, on the run, its font or its font color
+_RUN_FORMAT_ATTRIBUTES = ('bold', 'italic', 'underline', 'name', 'size', 'rgb', 'highlight_color')
 
-def translate_text_batch(client: AzureOpenAI, deployment_name: str, texts: List[str], target_language: str) -> List[str]:
+
+def build_request(deployment_name: str, texts: List[str], target_language: str) -> dict:
     """
-    Translate multiple text strings in a single API call for efficiency.
+    Build the chat completion request translating texts into the target language.
     
     Args:
-        client: Azure OpenAI client
         deployment_name: Azure OpenAI deployment name
-        texts: List of texts to translate
+        texts: List of non-empty texts to translate
         target_language: Target language
         
     Returns:
-        List of translated texts
+        Keyword arguments of the chat completion request
     """
-    if not texts or all(not text.strip() for text in texts):
-        return texts
-    
-    # Filter out empty texts but keep track of their positions
-    text_map = {}
-    non_empty_texts = []
-    for i, text in enumerate(texts):
-        if text.strip():
-            text_map[len(non_empty_texts)] = i
-            non_empty_texts.append(text)
-    
-    if not non_empty_texts:
-        return texts
-    
-    prompt = f"""Translate the following texts to {target_language}. 
+    prompt = f"""Translate the texts in the following JSON array to {target_language}. 
     Preserve the exact meaning and tone. Maintain any formatting markers or special characters.
-    Return only the translations, separated by "---TRANSLATION_SEPARATOR---", in the same order as provided.
+    Return a JSON object {{"t": [...]}} where "t" holds the translations, one per text, in the same order as provided.
 
     Texts to translate:
+    {orjson.dumps(texts).decode()}
     """
-    for i, text in enumerate(non_empty_texts):
-        prompt += f"\n{i+1}. {text}"
     
-    try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": "You are a professional translator. Translate accurately while preserving formatting and meaning."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=4000,
-            temperature=0
-        )
-        
-        translated_content = response.choices[0].message.content.strip()
-        
-        # Split the response by separator
-        if "---TRANSLATION_SEPARATOR---" in translated_content:
-            translated_parts = translated_content.split("---TRANSLATION_SEPARATOR---")
-        else:
-            # Fallback: split by numbered list if separator not used
-            translated_parts = []
-            lines = translated_content.split('\n')
-            current_translation = ""
-            
-            for line in lines:
-                line = line.strip()
-                if line and (line.startswith(f"{len(translated_parts)+1}.") or 
-                            line.startswith(f"{len(translated_parts)+1} ")):
-                    if current_translation:
-                        translated_parts.append(current_translation.strip())
-                    current_translation = line.split('.', 1)[1].strip() if '.' in line else line
-                else:
-                    current_translation += " " + line if current_translation and line else line
-            
-            if current_translation:
-                translated_parts.append(current_translation.strip())
-        
-        # Clean up translations and map back to original positions
-        result = texts.copy()
-        for i, translation in enumerate(translated_parts[:len(non_empty_texts)]):
-            original_index = text_map[i]
-            result[original_index] = translation.strip()
+    return {
+        "model": deployment_name,
+        "messages": [
+            {"role": "system", "content": "You are a professional translator. Translate accurately while preserving formatting and meaning. Always answer in JSON."},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": utils.MAX_OUTPUT_TOKENS,
+        "temperature": 0,
+        "response_format": {"type": "json_object"}
+    }
+
+
+def parse_response(translated_content: str, number_of_texts: int) -> List[str]:
+    """
+    Parse the translations from the content of a model response.
+    
+    Args:
+        translated_content: Message content of the response
+        number_of_texts: Number of texts in the request
         
-        return result
+    Returns:
+        List of translated texts
+    """
+    translations = orjson.loads(translated_content).get("t", [])
+    if len(translations) != number_of_texts:
+        raise ValueError(f"Number of translations ({len(translations)}) does not match number of texts ({number_of_texts})")
+    
+    return [translation.strip() for translation in translations]
+
+
+async def translate_text_batch(client: AsyncAzureOpenAI, deployment_name: str, texts: List[str], target_language: str) -> List[str]:
+    """
+    Translate multiple text strings in a single API call for efficiency.
+    Texts that were translated before are taken from the translation cache.
+    
+    Args:
+        client: Async Azure OpenAI client
+        deployment_name: Azure OpenAI deployment name
+        texts: List of texts to translate
+        target_language: Target language
         
+    Returns:
+        List of translated texts
+    """
+    async def translate(uncached_texts: List[str]) -> List[str]:
+        return await utils.request_translations(
+            client, uncached_texts, lambda batch: build_request(deployment_name, batch, target_language), parse_response)
+    
+    try:
+        return await utils.translate_cached(deployment_name, target_language, texts, translate)
     except Exception as e:
+        # Untranslated texts keep their original content
         print(f"Translation error: {e}")
-        # Return original texts if translation fails
         return texts
 
 
+async def translate_texts(client: AsyncAzureOpenAI, model: str, texts: List[str], target_language: str) -> List[str]:
+    """
+    Translate a list of texts by packing them into token-limited batches and submitting all batches concurrently.
+
+    Args:
+        client: Async Azure OpenAI client
+        model: Azure OpenAI deployment name
+        texts: List of texts to translate
+        target_language: Target language
+
+    Returns:
+        List of translated texts, in the same order as texts
+    """
+    batches = utils.pack_by_tokens(texts, max_tokens=utils.MAX_BATCH_TOKENS)
+    print(f"Processing {len(batches)} batch(es)")
+    results = await utils.gather_with_concurrency(
+        MAX_CONCURRENT_REQUESTS,
+        *[translate_text_batch(client=client,
+                               deployment_name=model,
+                               texts=batch,
+                               target_language=target_language) for batch in batches]
+    )
+    return list(itertools.chain.from_iterable(results))
+
+
 def collect_paragraph_texts(paragraphs) -> List[str]:
     """
     Collect all text content from paragraphs.
@@ -111,13 +142,41 @@ def collect_paragraph_texts(paragraphs) -> List[str]:
     """
     texts = []
     for paragraph in paragraphs:
-        if paragraph.text.strip():
-            texts.append(paragraph.text)
-        else:
-            texts.append("")
+        # paragraph.text re-scans the paragraph XML, so it is read only once
+        text = paragraph.text
+        texts.append(text if text.strip() else "")
     return texts
 
 
+def _snapshot_run_format(run) -> RunFormat:
+    """
+    Capture the formatting of a run.
+    
+    Args:
+        run: python-docx run object
+        
+    Returns:
+        RunFormat with the formatting of the run
+    """
+    font = run.font
+    return RunFormat(run.bold, run.italic, run.underline, font.name, font.size, font.color.rgb, font.highlight_color)
+
+
+def _apply_run_format(run, run_format: RunFormat):
+    """
+    Apply captured formatting to a run, skipping fields that are not set.
+    
+    Args:
+        run: python-docx run object
+        run_format: RunFormat captured with _snapshot_run_format
+    """
+    font = run.font
+    targets = (run, run, run, font, font, font.color, font)
+    for target, attribute, value in zip(targets, _RUN_FORMAT_ATTRIBUTES, run_format):
+        if value is not None:
+            setattr(target, attribute, value)
+
+
 def apply_translations_to_paragraphs(paragraphs, translations: List[str]):
     """
     Apply translations to paragraphs while preserving formatting.
@@ -130,98 +189,79 @@ def apply_translations_to_paragraphs(paragraphs, translations: List[str]):
         if not translation.strip():
             continue
             
-        # Store original formatting from first meaningful run
-        original_formatting = None
-        for run in paragraph.runs:
-            if run.text.strip():
-                original_formatting = {
-                    'bold': run.bold,
-                    'italic': run.italic,
-                    'underline': run.underline,
-                    'font_name': run.font.name,
-                    'font_size': run.font.size,
-                    'font_color': run.font.color.rgb if run.font.color.rgb else None,
-                    'highlight_color': run.font.highlight_color,
-                }
-                break
+        # Materialize the runs once, paragraph.runs re-parses the paragraph XML on every access
+        p = paragraph._p
+        runs = [Run(r, paragraph) for r in p.findall(_W_R)]
         
-        # Clear existing runs
-        for run in paragraph.runs:
-            run.clear()
+        # Store original formatting from first meaningful run
+        original_format = next((_snapshot_run_format(run) for run in runs if run.text.strip()), _EMPTY_RUN_FORMAT)
         
-        # Remove all runs except the first one
-        while len(paragraph.runs) > 1:
-            paragraph._element.remove(paragraph.runs[-1]._element)
+        # Remove all runs except the first one in a single pass over the paragraph element
+        for run in runs[1:]:
+            p.remove(run._r)
         
-        # Apply translation to first run
-        if paragraph.runs:
-            first_run = paragraph.runs[0]
+        # Apply translation to first run, replacing its content
+        if runs:
+            first_run = runs[0]
             first_run.text = translation
             
             # Apply original formatting
-            if original_formatting:
-                if original_formatting['bold'] is not None:
-                    first_run.bold = original_formatting['bold']
-                if original_formatting['italic'] is not None:
-                    first_run.italic = original_formatting['italic']
-                if original_formatting['underline'] is not None:
-                    first_run.underline = original_formatting['underline']
-                if original_formatting['font_name']:
-                    first_run.font.name = original_formatting['font_name']
-                if original_formatting['font_size']:
-                    first_run.font.size = original_formatting['font_size']
-                if original_formatting['font_color']:
-                    first_run.font.color.rgb = original_formatting['font_color']
-                if original_formatting['highlight_color']:
-                    first_run.font.highlight_color = original_formatting['highlight_color']
+            _apply_run_format(first_run, original_format)
 
 
-def translate_table_cells(client: AzureOpenAI, model: str, table, target_language: str):
+def collect_table_paragraphs(table) -> list:
     """
-    Translate all text in table cells using batch processing.
+    Collect all paragraphs from all cells of a table.
     
     Args:
         table: python-docx table object
+        
+    Returns:
+        List of paragraph objects
     """
-    all_paragraphs = []
-    
-    # Collect all paragraphs from all cells
+    paragraphs = []
     for row in table.rows:
         for cell in row.cells:
-            all_paragraphs.extend(cell.paragraphs)
-    
-    if not all_paragraphs:
-        return
-    
-    # Collect texts and translate in batches
-    texts = collect_paragraph_texts(all_paragraphs)
-    
-    # Process in batches of 20 to avoid token limits
-    batch_size = 20
-    translated_texts = []
+            paragraphs.extend(cell.paragraphs)
+    return paragraphs
+
+
+def collect_document_paragraphs(doc) -> list:
+    """
+    Collect the paragraphs of the body, tables, headers and footers of a document.
+    Paragraphs reachable in more than one way (merged table cells) are included only once.
     
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        batch_translations = translate_text_batch(client=client,
-                                                  deployment_name=model,
-                                                  texts=batch,
-                                                  target_language=target_language)
-        translated_texts.extend(batch_translations)
+    Args:
+        doc: python-docx document object
         
-        # Small delay between batches to avoid rate limiting
-        if i + batch_size < len(texts):
-            time.sleep(0.5)
+    Returns:
+        List of paragraph objects
+    """
+    paragraphs = list(doc.paragraphs)
+    for table in doc.tables:
+        paragraphs.extend(collect_table_paragraphs(table))
+    
+    for section in doc.sections:
+        for header_footer in (section.header, section.footer):
+            # a linked header or footer is the one of the previous section, which is collected already
+            if header_footer.is_linked_to_previous:
+                continue
+            paragraphs.extend(header_footer.paragraphs)
+            for table in header_footer.tables:
+                paragraphs.extend(collect_table_paragraphs(table))
     
-    # Apply translations
-    apply_translations_to_paragraphs(all_paragraphs, translated_texts)
+    unique_paragraphs = {}
+    for paragraph in paragraphs:
+        unique_paragraphs.setdefault(paragraph._p, paragraph)
+    return list(unique_paragraphs.values())
 
 
-def translate_docx_document(client: AzureOpenAI, model: str, input_path: str, target_language: str, output_folder: str, save_as_pdf: bool) -> bool:
+async def translate_docx_document(client: AsyncAzureOpenAI, model: str, input_path: str, target_language: str, output_folder: str, save_as_pdf: bool) -> bool:
     """
     Translate an entire DOCX document while preserving formatting.
     
     Args:
-        client: Azure OpenAI client
+        client: Async Azure OpenAI client
         model: chosen Azure OpenAI model deployment
         input_path: path to input .docx file
         target_language: language to translate to
@@ -234,91 +274,30 @@ def translate_docx_document(client: AzureOpenAI, model: str, input_path: str, ta
     try:
         file_name = os.path.basename(input_path)
         output_file_path = os.path.join(output_folder, target_language + "_" + file_name)
-        # Load the document
-        doc = Document(input_path)
-        
-        # Translate main document paragraphs
-        if doc.paragraphs:
-            texts = collect_paragraph_texts(doc.paragraphs)
-            
-            # Process in batches
-            batch_size = 20
-            translated_texts = []
-            
-            for i in range(0, len(texts), batch_size):
-                batch = texts[i:i + batch_size]
-                print(f"Processing batch {i//batch_size + 1}/{(len(texts)-1)//batch_size + 1}")
-                batch_translations = translate_text_batch(client=client,
-                                                          deployment_name=model,
-                                                          texts=batch,
-                                                          target_language=target_language)
-                translated_texts.extend(batch_translations)
-                
-                # Small delay between batches
-                if i + batch_size < len(texts):
-                    time.sleep(0.5)
-            
-            apply_translations_to_paragraphs(doc.paragraphs, translated_texts)
-        
-        # Translate tables
-        if doc.tables:
-            print("Translating tables...")
-            for table_idx, table in enumerate(doc.tables):
-                print(f"Processing table {table_idx+1}/{len(doc.tables)}")
-                translate_table_cells(client=client,
-                                      model=model,
-                                      table=table,
-                                      target_language=target_language)
+        # Load the document in a worker thread, so other files can be translated meanwhile
+        doc = await asyncio.to_thread(Document, input_path)
         
-        # Translate headers and footers
-        print("Translating headers and footers...")
-        for section_idx, section in enumerate(doc.sections):
-            print(f"  Processing section {section_idx+1}/{len(doc.sections)}")
-            
-            # Translate header
-            if section.header and section.header.paragraphs:
-                header_texts = collect_paragraph_texts(section.header.paragraphs)
-                header_translations = translate_text_batch(client=client,
-                                                           deployment_name=model,
-                                                           texts=header_texts,
-                                                           target_language=target_language)
-                apply_translations_to_paragraphs(section.header.paragraphs, header_translations)
-                
-                # Translate header tables
-                for table in section.header.tables:
-                    translate_table_cells(client=client,
-                                          model=model,
-                                          table=table,
-                                          target_language=target_language)
-            
-            # Translate footer
-            if section.footer and section.footer.paragraphs:
-                footer_texts = collect_paragraph_texts(section.footer.paragraphs)
-                footer_translations = translate_text_batch(client=client,
-                                                           deployment_name=model,
-                                                           texts=footer_texts,
-                                                           target_language=target_language)
-                apply_translations_to_paragraphs(section.footer.paragraphs, footer_translations)
-                
-                # Translate footer tables
-                for table in section.footer.tables:
-                    translate_table_cells(client=client,
-                                          model=model,
-                                          table=table,
-                                          target_language=target_language)
+        # Collect the paragraphs of body, tables, headers and footers, and translate them in one go
+        paragraphs = collect_document_paragraphs(doc)
+        print(f"Translating {len(paragraphs)} paragraphs...")
+        texts = collect_paragraph_texts(paragraphs)
+        translated_texts = await translate_texts(client=client,
+                                                 model=model,
+                                                 texts=texts,
+                                                 target_language=target_language)
+        apply_translations_to_paragraphs(paragraphs, translated_texts)
         
         # Save the translated document
         print(f"Saving translated document: {output_file_path}")
-        doc.save(output_file_path)
+        await asyncio.to_thread(doc.save, output_file_path)
 
         # if indicated, save as pdf file
         if save_as_pdf:
             pdf_file_name = os.path.splitext(file_name)[0] + ".pdf"
             pdf_file_path = os.path.join(output_folder, target_language + "_" + pdf_file_name)
-            utils.convert_docx_to_pdf(output_file_path, pdf_file_path)
+            await asyncio.to_thread(utils.convert_docx_to_pdf, output_file_path, pdf_file_path)
             # add watermark to created pdf file
-            watermark_file_path = os.path.abspath(os.path.join(os.getcwd(), "watermark.pdf"))
-            utils.add_watermark(pdf_file_path, pdf_file_path, watermark_file_path)
+            await asyncio.to_thread(utils.watermark_pdf, pdf_file_path, pdf_file_path)
             # remove converted .docx file
             os.remove(output_file_path)
 
@@ -5,58 +5,332 @@ This script reads a .pdf file, translates the text content using Azure OpenAI
 while preserving formatting, fonts, and layout as much as possible, then outputs a new translated .pdf file.
 
 """
+import io
 import os
+import re
+import asyncio
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 import pymupdf
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 import utils
+import batch_api
 
+# Maximum number of API calls in flight at the same time per document
+MAX_CONCURRENT_REQUESTS = 16
+# Number of pages translated at the same time in the page pipeline
+PAGE_WORKERS = 4
+# Maximum number of pages waiting between two stages of the page pipeline
+PIPELINE_QUEUE_SIZE = 8
+# PyMuPDF is not thread safe, so all PyMuPDF calls of all documents run one at a time in this single thread
+_PYMUPDF_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pymupdf")
+# Marker line preceding every block in a batch, and the pattern to split the response on
+SEGMENT_MARKER = "<<<SEG {}>>>"
+_SEGMENT_RE = re.compile(r"<<<SEG (\d+)>>>")
+# Split points after sentences, after clauses and before words, the whitespace stays with the next piece
+_SPLIT_RES = (re.compile(r"(?<=[.!?])(?=\s)"), re.compile(r"(?<=[,;:])(?=\s)"), re.compile(r"(?=\s)"))
+# System message and user prompt templates for a single text and for a batch of marked segments
+_SYSTEM_MSG = "You are a professional translator. Translate accurately while preserving formatting and context."
+_USER_PROMPT_TMPL = """Translate the following text to {target_language}. 
+    Maintain the original formatting, structure, and meaning as much as possible.
+    Only return the translated text, no additional comments or explanations.
+    
+    Text to translate:
+    {body}
+    """
+_BLOCKS_PROMPT_TMPL = """Translate the following text segments to {target_language}. 
+    Every segment starts with a marker line like """ + SEGMENT_MARKER.format(0) + """. Keep all marker lines unchanged and in the same order,
+    and put the translation of each segment directly after its marker line.
+    Maintain the original formatting, structure, and meaning as much as possible.
+    Only return the marker lines and translated segments, no additional comments or explanations.
+    
+    Segments to translate:
+    {body}
+    """
+# Color "white", used to cover the original text
+_WHITE = pymupdf.pdfcolor["white"]
+# This flag ensures that text will be dehyphenated after extraction
+_TEXTFLAGS = pymupdf.TEXT_DEHYPHENATE
 
-def translate_text(client: AzureOpenAI, model: str, text: str, target_language: str) -> str:
-    """Translate text using Azure OpenAI GPT-4o"""
-    try:
-        # Split text into chunks if it's too long (to handle token limits)
-        max_chunk_size = 3000  # Conservative chunk size
-        chunks = [text[i:i+max_chunk_size] for i in range(0, len(text), max_chunk_size)]
-        
-        translated_chunks = []
+
+def split_pieces(text: str, max_tokens: int, level: int = 0) -> List[str]:
+    """
+    Split text into sentences of at most max_tokens tokens. A sentence exceeding max_tokens is split
+    on clause punctuation, and a clause exceeding max_tokens is split into words.
+    """
+    if level == len(_SPLIT_RES) or utils.count_tokens(text) <= max_tokens:
+        return [text]
+    pieces = []
+    for piece in _SPLIT_RES[level].split(text):
+        if piece:
+            pieces.extend(split_pieces(piece, max_tokens, level + 1))
+    return pieces
+
+
+def chunk_by_sentences(text: str, max_tokens: int) -> List[str]:
+    """
+    Split text into chunks of whole sentences, greedily packing sentences up to a token budget.
+    
+    Args:
+        text: text to split
+        max_tokens: token budget per chunk
         
-        for chunk in chunks:
-            if not chunk.strip():
-                continue
-                
-            prompt = f"""Translate the following text to {target_language}. 
-            Maintain the original formatting, structure, and meaning as much as possible.
-            Only return the translated text, no additional comments or explanations.
-            
-            Text to translate:
-            {chunk}
-            """
-            
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are a professional translator. Translate accurately while preserving formatting and context."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=4000,
-                temperature=0
-            )
-            
-            translated_chunks.append(response.choices[0].message.content)
+    Returns:
+        List of chunks, concatenating the chunks gives back text
+    """
+    pieces = split_pieces(text, max_tokens)
+    return ["".join(batch) for batch in utils.pack_by_tokens(pieces, max_tokens=max_tokens)]
+
+
+def build_text_request(model: str, text: str, target_language: str) -> dict:
+    """Build the chat completion request translating a single text of at most utils.MAX_BATCH_TOKENS tokens"""
+    prompt = _USER_PROMPT_TMPL.format(target_language=target_language, body=text)
+    
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": _SYSTEM_MSG},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": utils.MAX_OUTPUT_TOKENS,
+        "temperature": 0
+    }
+
+
+def build_blocks_request(model: str, blocks: List[str], target_language: str) -> dict:
+    """Build the chat completion request translating multiple blocks, separated by numbered markers"""
+    segments = "".join(f"\n{SEGMENT_MARKER.format(i)}\n{block}" for i, block in enumerate(blocks))
+    prompt = _BLOCKS_PROMPT_TMPL.format(target_language=target_language, body=segments)
+    
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": _SYSTEM_MSG},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": utils.MAX_OUTPUT_TOKENS,
+        "temperature": 0
+    }
+
+
+def parse_blocks_response(content: str, number_of_blocks: int) -> List[Optional[str]]:
+    """Parse the block translations from a response, None for a block whose translation is missing"""
+    # splitting on the markers gives [preamble, number, translation, number, translation, ...]
+    parts = _SEGMENT_RE.split(content)
+    translations = {int(number): translation.strip() for number, translation in zip(parts[1::2], parts[2::2])}
+    return [translations.get(i) for i in range(number_of_blocks)]
+
+
+async def translate_text(client: AsyncAzureOpenAI, model: str, text: str, target_language: str) -> str:
+    """Translate text using Azure OpenAI GPT-4o, raises an exception if translation fails"""
+    # Split text into chunks of whole sentences if it's too long (to handle token limits)
+    chunks = chunk_by_sentences(text, max_tokens=utils.MAX_BATCH_TOKENS)
+    
+    translated_chunks = []
+    
+    for chunk in chunks:
+        if not chunk.strip():
+            continue
+        if not utils.is_translatable(chunk):
+            # numbers, urls and symbols are kept as they are
+            translated_chunks.append(chunk.strip())
+            continue
         
-        return '\n'.join(translated_chunks)
+        translated_chunks.extend(await utils.request_translations(
+            client, [chunk], lambda texts: build_text_request(model, texts[0], target_language),
+            lambda content, _: [content]))
+    
+    return '\n'.join(translated_chunks)
+
+
+async def translate_blocks_batch(client: AsyncAzureOpenAI, model: str, blocks: List[str], target_language: str) -> List[Optional[str]]:
+    """
+    Translate multiple text blocks in a single API call, separating the blocks by numbered markers.
+    A response that is cut off at the maximum number of output tokens is requested again in two halves,
+    so a cut off last segment is never taken as a translation.
+    
+    Args:
+        client: Async Azure OpenAI client
+        model: Azure OpenAI deployment name
+        blocks: List of block texts to translate
+        target_language: Target language
         
+    Returns:
+        List of translated block texts, None for a block whose translation is missing in the response
+    """
+    return await utils.request_translations(client, blocks,
+                                            lambda batch: build_blocks_request(model, batch, target_language),
+                                            parse_blocks_response)
+
+
+async def translate_blocks(client: AsyncAzureOpenAI, model: str, blocks: List[str], target_language: str) -> List[str]:
+    """
+    Translate a batch of blocks packed by token count. Blocks that need no translation are skipped,
+    blocks that were translated before are taken from the translation cache, a single block exceeding the token budget is translated on its own.
+    Blocks that could not be translated keep their original text.
+    """
+    async def translate(uncached_blocks: List[str]) -> List[Optional[str]]:
+        if len(uncached_blocks) == 1 and utils.count_tokens(uncached_blocks[0]) > utils.MAX_BATCH_TOKENS:
+            return [await translate_text(client=client, model=model, text=uncached_blocks[0], target_language=target_language)]
+        return await translate_blocks_batch(client=client, model=model, blocks=uncached_blocks, target_language=target_language)
+    
+    try:
+        return await utils.translate_cached(model, target_language, blocks, translate)
     except Exception as e:
-        return f"Translation error: {str(e)}"
+        print(f"Translation error: {e}")
+        return blocks
 
 
-def translate_pdf_document(client: AzureOpenAI, model: str, input_path: str, target_language: str, output_path: str) -> bool:
+async def translate_batches_with_batch_api(client: AsyncAzureOpenAI, model: str, batches: List[List[str]], target_language: str) -> List[List[str]]:
+    """
+    Translate all batches of blocks of a document in a single Batch API job. Blocks that were translated before
+    are taken from the translation cache, a single block exceeding the token budget is split into chunks of whole
+    sentences that are requested separately. Blocks that could not be translated keep their original text.
+    """
+    async def translate_batches(uncached_batches: List[List[str]]) -> List[List[Optional[str]]]:
+        requests = {}
+        chunks_per_batch = {}
+        for i, batch in enumerate(uncached_batches):
+            if len(batch) == 1 and utils.count_tokens(batch[0]) > utils.MAX_BATCH_TOKENS:
+                chunks = [chunk for chunk in chunk_by_sentences(batch[0], max_tokens=utils.MAX_BATCH_TOKENS) if chunk.strip()]
+                chunks_per_batch[i] = len(chunks)
+                for j, chunk in enumerate(chunks):
+                    requests[f"text-{i}-{j}"] = build_text_request(model, chunk, target_language)
+            else:
+                requests[f"batch-{i}"] = build_blocks_request(model, batch, target_language)
+        responses = await batch_api.run_batch(client, requests)
+        
+        results = []
+        for i, batch in enumerate(uncached_batches):
+            try:
+                if i in chunks_per_batch:
+                    chunk_ids = [f"text-{i}-{j}" for j in range(chunks_per_batch[i])]
+                    results.append(['\n'.join(responses[chunk_id] for chunk_id in chunk_ids)])
+                else:
+                    results.append(parse_blocks_response(responses[f"batch-{i}"], len(batch)))
+            except (KeyError, ValueError) as e:
+                # Blocks of a failed, cut off or invalid request keep their original text, the other batches are kept
+                print(f"Translation error in batch {i}: {e!r}")
+                results.append([None] * len(batch))
+        return results
+    
+    return await utils.translate_cached_batches(model, target_language, batches, translate_batches)
+
+
+def extract_page_blocks(doc: pymupdf.Document, page_number: int) -> Tuple[List[tuple], List[str]]:
+    """
+    Extract the text blocks of a page, every block of text is contained in a rectangle ("bbox").
+    
+    Returns:
+        Tuple of (bboxes, texts) of the blocks
+    """
+    # Extract text grouped like lines in a paragraph.
+    blocks = doc[page_number].get_text("blocks", flags=_TEXTFLAGS)
+    return [block[:4] for block in blocks], [block[4] for block in blocks]
+
+
+def extract_document_blocks(doc: pymupdf.Document) -> List[Tuple[List[tuple], List[str]]]:
+    """Extract the text blocks of all pages, as a (bboxes, texts) tuple per page"""
+    return [extract_page_blocks(doc, page_number) for page_number in range(doc.page_count)]
+
+
+def write_document_translations(doc: pymupdf.Document, pages: List[Tuple[List[tuple], List[str]]], translated_texts: List[str], ocg_xref: int):
+    """Write the translated texts of the blocks of all pages, in the order of the blocks in pages"""
+    translated_iter = iter(translated_texts)
+    for page_number, (bboxes, texts) in enumerate(pages):
+        write_page_translations(doc, page_number, bboxes, list(itertools.islice(translated_iter, len(texts))), ocg_xref)
+
+
+def write_page_translations(doc: pymupdf.Document, page_number: int, bboxes: List[tuple], translated_texts: List[str], ocg_xref: int):
+    """
+    Cover the original text blocks of a page and write the translated texts into their rectangles,
+    on the Optional Content layer ocg_xref.
+    """
+    page = doc[page_number]
+    # Cover the original text with white rectangles, drawn as one shape so the page content is updated once
+    shape = page.new_shape()
+    for bbox in bboxes:
+        shape.draw_rect(bbox)
+        shape.finish(color=None, fill=_WHITE, oc=ocg_xref)
+    shape.commit(overlay=True)
+    # Write the translated texts into the rectangles
+    for bbox, translated_text in zip(bboxes, translated_texts):
+        page.insert_htmlbox(bbox, translated_text, oc=ocg_xref)
+
+
+async def translate_pages_pipelined(client: AsyncAzureOpenAI, model: str, doc: pymupdf.Document, target_language: str, ocg_xref: int):
+    """
+    Translate all pages of a document in a pipeline: an extractor extracts the blocks page by page,
+    PAGE_WORKERS translators translate the pages concurrently, and a writer applies the translations
+    in page order as soon as they are available. The queues between the stages are bounded, so only
+    a limited number of pages is kept in memory.
+    All document access runs in the PyMuPDF thread.
+    """
+    loop = asyncio.get_running_loop()
+    extracted = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    translated = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # API calls of all pages together are limited to MAX_CONCURRENT_REQUESTS
+    request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    async def translate_limited(blocks: List[str]) -> List[str]:
+        async with request_semaphore:
+            return await translate_blocks(client=client, model=model, blocks=blocks, target_language=target_language)
+    
+    async def extractor():
+        page_count = await loop.run_in_executor(_PYMUPDF_EXECUTOR, lambda: doc.page_count)
+        for page_number in range(page_count):
+            bboxes, texts = await loop.run_in_executor(_PYMUPDF_EXECUTOR, extract_page_blocks, doc, page_number)
+            await extracted.put((page_number, bboxes, texts))
+        for _ in range(PAGE_WORKERS):
+            await extracted.put(None)
+    
+    async def translator():
+        while (item := await extracted.get()) is not None:
+            page_number, bboxes, texts = item
+            # Pack the blocks of the page into batches up to a token budget, and translate them concurrently
+            batches = utils.pack_by_tokens(texts, max_tokens=utils.MAX_BATCH_TOKENS)
+            results = await asyncio.gather(*[translate_limited(batch) for batch in batches])
+            await translated.put((page_number, bboxes, list(itertools.chain.from_iterable(results))))
+        await translated.put(None)
+    
+    async def writer():
+        # Translated pages that arrived before their predecessors, ordered by page number
+        waiting = []
+        next_page_number = 0
+        finished_translators = 0
+        while finished_translators < PAGE_WORKERS:
+            item = await translated.get()
+            if item is None:
+                finished_translators += 1
+                continue
+            heapq.heappush(waiting, item)
+            while waiting and waiting[0][0] == next_page_number:
+                page_number, bboxes, translated_texts = heapq.heappop(waiting)
+                await loop.run_in_executor(_PYMUPDF_EXECUTOR, write_page_translations,
+                                           doc, page_number, bboxes, translated_texts, ocg_xref)
+                next_page_number += 1
+    
+    tasks = [asyncio.create_task(extractor()), asyncio.create_task(writer()),
+             *[asyncio.create_task(translator()) for _ in range(PAGE_WORKERS)]]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # a failing stage would leave the other stages waiting on their queues forever
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def translate_pdf_document(client: AsyncAzureOpenAI, model: str, input_path: str, target_language: str, output_path: str, use_batch_api: bool = False) -> bool:
     """
     Translate an entire pdf document while preserving formatting.
     
     Args:
         input_path: Path to input .pdf file
         output_path: Path to output .pdf file
+        use_batch_api: Indicator to submit all translations as one Batch API job
         
     Returns:
         True if successful, False otherwise
@@ -64,40 +338,44 @@ def translate_pdf_document(client: AzureOpenAI, model: str, input_path: str, tar
     try:
         file_name = os.path.basename(input_path)
         output_file_path = os.path.join(output_path, target_language + "_" + file_name)
-        # utils.add_watermark(file_name, output_pdf, watermark_pdf)
-        # Define color "white"
-        WHITE = pymupdf.pdfcolor["white"]
-        # This flag ensures that text will be dehyphenated after extraction.
-        textflags = pymupdf.TEXT_DEHYPHENATE
+        loop = asyncio.get_running_loop()
         # Open the document
-        doc = pymupdf.open(input_path)
-        # Define an Optional Content layer in the document named "translation", and activate it by default.
-        ocg_xref = doc.add_ocg("translation", on=True)
-        # Iterate over all pages
-        for i, page in enumerate(doc.pages()):
-            # Extract text grouped like lines in a paragraph.
-            blocks = page.get_text("blocks", flags=textflags)
-            # Every block of text is contained in a rectangle ("bbox")
-            for block in blocks:
-                # area containing the text
-                bbox = block[:4]
-                # the text of this block
-                block_text = block[4]
-                # Invoke the actual translation
-                translated_text = translate_text(client=client,
-                                                 model=model,
-                                                 text=block_text,
-                                                 target_language=target_language)
-                # Cover the original text with a white rectangle.
-                page.draw_rect(bbox, color=None, fill=WHITE, oc=ocg_xref)
-                # Write the translated text into the rectangle
-                page.insert_htmlbox(bbox, translated_text, oc=ocg_xref)
-        # save file to output folder and add watermark
-        doc.ez_save(output_file_path)
-        doc.close()
-        # add watermark
-        watermark_file_path = os.path.abspath(os.path.join(os.getcwd(), "watermark.pdf"))
-        utils.add_watermark(output_file_path, output_file_path, watermark_file_path)
+        doc = await loop.run_in_executor(_PYMUPDF_EXECUTOR, pymupdf.open, input_path)
+        try:
+            # Define an Optional Content layer in the document named "translation", and activate it by default.
+            ocg_xref = await loop.run_in_executor(_PYMUPDF_EXECUTOR, lambda: doc.add_ocg("translation", on=True))
+            if use_batch_api:
+                # Collect the text blocks of all pages
+                pages = await loop.run_in_executor(_PYMUPDF_EXECUTOR, extract_document_blocks, doc)
+                block_texts = [text for _, texts in pages for text in texts]
+                # Numbers, urls and symbols keep their original text and are not sent to the model
+                translatable_texts = [text for text in block_texts if utils.is_translatable(text)]
+                # Tokenize every block once, the counts are reused for packing the batches
+                block_tokens = [utils.count_tokens(block_text) for block_text in translatable_texts]
+                batches = utils.pack_by_tokens(translatable_texts, max_tokens=utils.MAX_BATCH_TOKENS, token_counts=block_tokens)
+                # Translate all batches in one Batch API job
+                results = await translate_batches_with_batch_api(client=client,
+                                                                 model=model,
+                                                                 batches=batches,
+                                                                 target_language=target_language)
+                translations = dict(zip(translatable_texts, itertools.chain.from_iterable(results)))
+                await loop.run_in_executor(_PYMUPDF_EXECUTOR, write_document_translations, doc, pages,
+                                           [translations.get(text, text) for text in block_texts], ocg_xref)
+            else:
+                await translate_pages_pipelined(client=client,
+                                                model=model,
+                                                doc=doc,
+                                                target_language=target_language,
+                                                ocg_xref=ocg_xref)
+            # save file in memory, and write it to the output folder with a watermark added
+            # same options as ez_save
+            pdf_bytes = await loop.run_in_executor(
+                _PYMUPDF_EXECUTOR,
+                lambda: doc.tobytes(garbage=3, deflate=True, deflate_images=True, deflate_fonts=True,
+                                    no_new_id=True, use_objstms=1))
+        finally:
+            await loop.run_in_executor(_PYMUPDF_EXECUTOR, doc.close)
+        await asyncio.to_thread(utils.watermark_pdf, io.BytesIO(pdf_bytes), output_file_path)
 
         return True
         
@@ -107,4 +385,3 @@ def translate_pdf_document(client: AzureOpenAI, model: str, input_path: str, tar
         traceback.print_exc()
         
         return False
-
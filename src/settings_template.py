@@ -1,8 +1,24 @@
-# AZURE_DEPLOYMENT_NAME is a deployment name that reflects the OpenAI LLM model used through Azure
+# AZURE_DEPLOYMENT_NAME is a deployment name that reflects the OpenAI LLM model used through Azure.
+# .txt files are translated with structured outputs (json_schema), which requires gpt-4o version 2024-08-06 or later
 AZURE_DEPLOYMENT_NAME = "your_deployment_name"
 
 # AZURE_OPENAI_ENDPOINT represents the Azure OpenAI endpoint used for connecting to Azure OpenAI API
 AZURE_OPENAI_ENDPOINT = "your_azure_openai_endpoint"
 
-# AZURE_OPENAI_API_VERSION represents the Azure OpenAI API version
+# AZURE_OPENAI_API_VERSION represents the Azure OpenAI API version, structured outputs require 2024-08-01-preview or later
 AZURE_OPENAI_API_VERSION = "your_azure_openai_api_version"
+
+# AZURE_RPM is the maximum number of requests per minute allowed by the Azure OpenAI deployment
+AZURE_RPM = 60
+
+# BATCH_MODE indicates whether .txt and .pdf files are translated with the Azure OpenAI Batch API (about half the cost,
+# no requests per minute limit, but results can take up to 24 hours). Requires a deployment of type "Global Batch"
+BATCH_MODE = False
+
+# HTTP_MAX_CONNECTIONS is the maximum number of open connections to the Azure OpenAI endpoint. It should be at least
+# the number of concurrent requests (MAX_CONCURRENT_FILES times the concurrent requests per document, 8 x 16 for .pdf)
+HTTP_MAX_CONNECTIONS = 128
+
+# MAX_OUTPUT_TOKENS is the maximum number of tokens of a single model response. It must not exceed the output limit
+# of the model (16384 for gpt-4o 2024-08-06, 4096 for older gpt-4o versions)
+MAX_OUTPUT_TOKENS = 8000
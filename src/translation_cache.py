@@ -0,0 +1,102 @@
+"""
+Persistent translation cache
+
+Translations are stored in a SQLite database, keyed by a hash of the model, target language and
+source text. Texts that occur repeatedly (headers, footers, boilerplate, table cells) or documents
+that are translated again therefore only need to be sent to Azure OpenAI once.
+
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+# Location of the cache database
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "appl-doctranslate", "translations.db")
+# Number of seconds after which a cached translation expires
+EXPIRE_SECONDS = 30 * 86400
+# Maximum number of keys per SELECT query, stays below the SQLite host parameter limit
+QUERY_CHUNK_SIZE = 500
+
+_connection = None
+_lock = threading.Lock()
+
+
+def _get_connection() -> sqlite3.Connection:
+    """
+    Open the cache database on first use, create the table if needed and delete expired translations.
+    """
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        _connection = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations "
+            "(key TEXT PRIMARY KEY, translation TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        # expired translations are never returned, deleting them keeps the database from growing without bound
+        _connection.execute("DELETE FROM translations WHERE created < ?", (time.time() - EXPIRE_SECONDS,))
+        _connection.commit()
+    return _connection
+
+
+def make_key(model: str, target_language: str, text: str) -> str:
+    """
+    Create the cache key of a text translated by a model into a target language.
+
+    Args:
+        model: Azure OpenAI deployment name
+        target_language: Target language
+        text: Source text
+
+    Returns:
+        Hex digest identifying the translation
+    """
+    return hashlib.sha256(f"{model}|{target_language}|{text}".encode("utf-8")).hexdigest()
+
+
+def get_many(keys: List[str]) -> Dict[str, str]:
+    """
+    Look up cached translations.
+
+    Args:
+        keys: Cache keys created with make_key
+
+    Returns:
+        Dictionary with the translation of each key that is present in the cache and not expired
+    """
+    found = {}
+    unique_keys = list(dict.fromkeys(keys))
+    oldest = time.time() - EXPIRE_SECONDS
+    with _lock:
+        connection = _get_connection()
+        for i in range(0, len(unique_keys), QUERY_CHUNK_SIZE):
+            chunk = unique_keys[i:i + QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT key, translation FROM translations WHERE key IN ({placeholders}) AND created >= ?",
+                [*chunk, oldest]
+            )
+            found.update(rows)
+    return found
+
+
+def set_many(translations: Dict[str, str]):
+    """
+    Store translations in the cache.
+
+    Args:
+        translations: Dictionary of cache key to translation
+    """
+    if not translations:
+        return
+    now = time.time()
+    with _lock:
+        connection = _get_connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO translations (key, translation, created) VALUES (?, ?, ?)",
+            [(key, translation, now) for key, translation in translations.items()]
+        )
+        connection.commit()
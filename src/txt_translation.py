@@ -6,119 +6,163 @@ while preserving text structure, spacing, indentation, and layout, then outputs
 a new translated .txt file.
 
 """
+import codecs
 import os
 import re
-import time
-from typing import List, Tuple, Dict
-from openai import AzureOpenAI
+import asyncio
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, TextIO, Tuple
+import orjson
+from charset_normalizer import from_bytes
+from openai import AsyncAzureOpenAI
 # local imports
 import utils
+import batch_api
 
+# Maximum number of API calls in flight at the same time per document
+MAX_CONCURRENT_REQUESTS = 8
+# A line split into leading whitespace, content and trailing whitespace (any whitespace except newlines)
+_LINE_RE = re.compile(r'^([^\S\n]*)(.*?)([^\S\n]*)$', re.MULTILINE)
+# Number of bytes at the start of a file that are used to detect its encoding
+ENCODING_SAMPLE_SIZE = 65536
+# Encodings that are tried in order when the file is not UTF-8 and the encoding can not be detected from the sample
+FALLBACK_ENCODINGS = ('latin-1', 'cp1252', 'iso-8859-1')
+# Buffer size of the output file, so the lines are written to disk in large chunks
+OUTPUT_BUFFER_SIZE = 1 << 20
+# System message and user prompt template, the segments are inserted as a JSON array
+_SYSTEM_MSG = "You are a professional translator. Translate accurately while preserving formatting, structure, and meaning. Return exactly one translation per text segment, in the same order as provided."
+_USER_PROMPT_TMPL = """Translate the texts in the following JSON array to {target_language}.
+    IMPORTANT INSTRUCTIONS:
+    - Preserve the exact meaning and tone of each segment
+    - Maintain any special formatting, punctuation, or symbols
+    - Keep the same structure and style as the original
+    - Each segment should be translated independently but consider context
+    - Return the translations in "items", exactly one per segment, in the exact same order
+    - Do not add explanations, numbers, or extra text
+
+    Text segments to translate:
+    {body}"""
+# Structured output of the model: an object with the array of translations in "items"
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "translations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"items": {"type": "array", "items": {"type": "string"}}},
+            "required": ["items"],
+            "additionalProperties": False
+        }
+    }
+}
 
-def detect_encoding(file_path: str) -> str:
+@dataclass
+class TextStructure:
     """
-    Detect the encoding of a text file.
+    Structure of a text as parallel lists with one entry per line.
+    The leading whitespace of an empty or whitespace-only line is the complete line.
+    """
+    leading_whitespace: List[str]
+    contents: List[str]
+    trailing_whitespace: List[str]
+    is_empty: List[bool]
+
+
+def read_text_autodetect(file_path: str) -> Tuple[str, str]:
+    """
+    Read a text file and decode it with its detected encoding, the file is read and decoded only once.
     
     Args:
         file_path: Path to the text file
         
     Returns:
-        Detected encoding
+        Tuple of (text, encoding)
     """
-    encodings = ['utf-8', 'utf-8-sig', 'latin-1', 'cp1252', 'iso-8859-1']
+    raw = Path(file_path).read_bytes()
     
+    # Valid UTF-8 is taken as UTF-8, detection on a short sample can mistake it for another encoding
+    utf8_encoding = 'utf-8-sig' if raw.startswith(codecs.BOM_UTF8) else 'utf-8'
+    try:
+        return raw.decode(utf8_encoding), utf8_encoding
+    except UnicodeDecodeError:
+        pass
+    
+    # Detect the encoding from a sample at the start of the file, and fall back to trying encodings in order
+    best_match = from_bytes(raw[:ENCODING_SAMPLE_SIZE]).best()
+    encodings = FALLBACK_ENCODINGS if best_match is None else (best_match.encoding, *FALLBACK_ENCODINGS)
     for encoding in encodings:
         try:
-            with open(file_path, 'r', encoding=encoding) as f:
-                f.read()
-            return encoding
+            return raw.decode(encoding), encoding
         except UnicodeDecodeError:
             continue
     
     # Fallback to utf-8 with error handling
-    return 'utf-8'
+    return raw.decode('utf-8', errors='replace'), 'utf-8'
 
 
-def parse_text_structure(text: str) -> List[Dict]:
+def parse_text_structure(text: str) -> TextStructure:
     """
-    Parse text into structured segments preserving formatting.
+    Parse text into structured segments preserving formatting, using a single regex pass over the whole text.
     
     Args:
         text: Input text content
         
     Returns:
-        List of dictionaries with structure information
+        TextStructure with the leading whitespace, content and trailing whitespace of each line
     """
-    lines = text.split('\n')
-    structures = []
+    matches = _LINE_RE.findall(text)
+    contents = [content for _, content, _ in matches]
     
-    for line_num, line in enumerate(lines):
-        if not line.strip():
-            # Empty line or whitespace-only line
-            structures.append({
-                'content': "",
-                'leading_whitespace': line,
-                'trailing_whitespace': "",
-                'is_empty': True,
-                'line_number': line_num
-            })
-        else:
-            # Line with content - extract leading and trailing whitespace
-            leading_match = re.match(r'^(\s*)', line)
-            trailing_match = re.search(r'(\s*)$', line)
-            
-            leading_ws = leading_match.group(1) if leading_match else ""
-            trailing_ws = trailing_match.group(1) if trailing_match else ""
-            content = line.strip()
-            
-            structures.append({
-                'content': content,
-                'leading_whitespace': leading_ws,
-                'trailing_whitespace': trailing_ws,
-                'is_empty': False,
-                'line_number': line_num
-            })
-    
-    return structures
+    return TextStructure(leading_whitespace=[leading for leading, _, _ in matches],
+                         contents=contents,
+                         trailing_whitespace=[trailing for _, _, trailing in matches],
+                         is_empty=[not content for content in contents])
 
 
-def group_structures_for_translation(structures: List[Dict]) -> List[Tuple[List[int], List[str]]]:
+def group_structures_for_translation(structure: TextStructure, tokens_per_struct: List[int]) -> List[Tuple[List[int], List[str]]]:
     """
     Group text structures into translation batches while preserving context.
     
     Args:
-        structures: List of structure dictionaries
+        structure: TextStructure of the text
+        tokens_per_struct: Number of tokens of the content of each line
         
     Returns:
         List of tuples containing (indices, texts) for batch translation
     """
+    is_empty = structure.is_empty
     batches = []
     current_batch_indices = []
     current_batch_texts = []
     current_length = 0
-    max_batch_length = 3000  # Conservative limit for token count
     
-    for i, struct in enumerate(structures):
-        if struct['is_empty'] or not struct['content'].strip():
+    for i, content in enumerate(structure.contents):
+        if is_empty[i]:
             # If we have accumulated content, finish the current batch
             if current_batch_texts:
-                batches.append((current_batch_indices.copy(), current_batch_texts.copy()))
-                current_batch_indices.clear()
-                current_batch_texts.clear()
+                batches.append((current_batch_indices, current_batch_texts))
+                current_batch_indices = []
+                current_batch_texts = []
                 current_length = 0
             continue
         
-        text_length = len(struct['content'])
+        # Numbers, urls and symbols keep their original content and are not sent to the model
+        if not utils.is_translatable(content):
+            continue
+        
+        text_length = tokens_per_struct[i]
         
         # Start new batch if current would be too long
-        if current_length + text_length > max_batch_length and current_batch_texts:
-            batches.append((current_batch_indices.copy(), current_batch_texts.copy()))
-            current_batch_indices.clear()
-            current_batch_texts.clear()
+        if current_length + text_length > utils.MAX_BATCH_TOKENS and current_batch_texts:
+            batches.append((current_batch_indices, current_batch_texts))
+            current_batch_indices = []
+            current_batch_texts = []
             current_length = 0
         
         current_batch_indices.append(i)
-        current_batch_texts.append(struct['content'])
+        current_batch_texts.append(content)
         current_length += text_length
     
     # Add final batch if it has content
@@ -128,105 +172,161 @@ def group_structures_for_translation(structures: List[Dict]) -> List[Tuple[List[
     return batches
 
 
-def translate_text_batch(client: AzureOpenAI, deployment_name: str, texts: List[str], target_language: str) -> List[str]:
+def build_request(deployment_name: str, texts: List[str], target_language: str) -> dict:
     """
-    Translate multiple text strings in a single API call.
+    Build the chat completion request translating texts into the target language.
     
     Args:
-        client: Azure OpenAI client
         deployment_name: Azure OpenAI deployment name
         texts: List of texts to translate
         target_language: Target language
         
     Returns:
-        List of translated texts
+        Keyword arguments of the chat completion request
     """
-    if not texts or all(not text.strip() for text in texts):
-        return texts
+    prompt = _USER_PROMPT_TMPL.format(target_language=target_language, body=orjson.dumps(texts).decode())
     
-    prompt = f"""Translate the following texts to {target_language}.
-    IMPORTANT INSTRUCTIONS:
-    - Preserve the exact meaning and tone of each segment
-    - Maintain any special formatting, punctuation, or symbols
-    - Keep the same structure and style as the original
-    - Each segment should be translated independently but consider context
-    - Return ONLY the translations, one per line, in the exact same order
-    - Do not add explanations, numbers, or extra text
+    return {
+        "model": deployment_name,
+        "messages": [
+            {"role": "system", "content": _SYSTEM_MSG},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": utils.MAX_OUTPUT_TOKENS,
+        "temperature": 0,
+        "response_format": RESPONSE_FORMAT
+    }
 
-    Text segments to translate:
+
+def parse_response(translated_content: str, number_of_texts: int) -> List[str]:
     """
-    for text in texts:
-        prompt += f"{text}\n"
+    Parse the translations from the content of a model response.
     
-    try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {
-                    "role": "system", 
-                    "content": "You are a professional translator. Translate accurately while preserving formatting, structure, and meaning. Return only the translated text, one translation per line, in the same order as provided."
-                },
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=4000,
-            temperature=0
-        )
-        
-        translated_content = response.choices[0].message.content.strip()
-        translated_lines = translated_content.split('\n')
-        
-        # Clean up translations and ensure we have the right number
-        cleaned_translations = []
-        for line in translated_lines:
-            line = line.strip()
-            if line:  # Only add non-empty lines
-                # Remove numbering if the model added it
-                line = re.sub(r'^\d+\.\s*', '', line)
-                cleaned_translations.append(line)
-        
-        # Ensure we have the same number of translations as inputs
-        while len(cleaned_translations) < len(texts):
-            cleaned_translations.append(texts[len(cleaned_translations)])
+    Args:
+        translated_content: Message content of the response
+        number_of_texts: Number of texts in the request
         
-        return cleaned_translations[:len(texts)]
+    Returns:
+        List of translated texts
+    """
+    translations = [translation.strip() for translation in orjson.loads(translated_content)["items"]]
+    if len(translations) != number_of_texts:
+        raise ValueError(f"Number of translations ({len(translations)}) does not match number of texts ({number_of_texts})")
+    
+    return translations
+
+
+async def translate_text_batch(client: AsyncAzureOpenAI, deployment_name: str, texts: List[str], target_language: str) -> Optional[List[str]]:
+    """
+    Translate multiple text strings in a single API call.
+    Texts that were translated before are taken from the translation cache.
+    
+    Args:
+        client: Azure OpenAI client
+        deployment_name: Azure OpenAI deployment name
+        texts: List of texts to translate
+        target_language: Target language
         
+    Returns:
+        List of translated texts, None if the translation failed
+    """
+    async def translate(uncached_texts: List[str]) -> List[str]:
+        return await utils.request_translations(
+            client, uncached_texts, lambda batch: build_request(deployment_name, batch, target_language), parse_response)
+    
+    try:
+        return await utils.translate_cached(deployment_name, target_language, texts, translate)
     except Exception as e:
         print(f"Translation error: {e}")
-        return texts  # Return original texts if translation fails
+        return None
 
 
-def reconstruct_text(structures: List[Dict]) -> str:
+async def translate_batches_with_batch_api(client: AsyncAzureOpenAI, deployment_name: str, texts_per_batch: List[List[str]], target_language: str) -> List[List[str]]:
     """
-    Reconstruct the text from structure dictionaries.
+    Translate all batches of a document in a single Batch API job.
+    Texts that were translated before are taken from the translation cache.
     
     Args:
-        structures: List of structure dictionaries
+        client: Async Azure OpenAI client
+        deployment_name: Azure OpenAI deployment name of type "Global Batch"
+        texts_per_batch: List of texts of each translation batch
+        target_language: Target language
         
     Returns:
-        Reconstructed text with preserved formatting
+        List of translated texts of each batch, texts without translation keep their original content.
+        Raises RuntimeError if none of the requests of the job could be translated.
     """
-    lines = []
-    for struct in structures:
-        if struct['is_empty']:
-            lines.append(struct['leading_whitespace'])
-        else:
-            reconstructed_line = struct['leading_whitespace'] + struct['content'] + struct['trailing_whitespace']
-            lines.append(reconstructed_line)
+    async def translate_batches(batches: List[List[str]]) -> List[List[Optional[str]]]:
+        requests = {f"batch-{i}": build_request(deployment_name, texts, target_language)
+                    for i, texts in enumerate(batches)}
+        responses = await batch_api.run_batch(client, requests)
+        
+        results = []
+        failed = 0
+        for i, texts in enumerate(batches):
+            try:
+                results.append(parse_response(responses[f"batch-{i}"], len(texts)))
+            except (KeyError, ValueError) as e:
+                # Texts of a failed or invalid request keep their original content, the other batches are kept
+                print(f"Translation error in batch {i}: {e!r}")
+                results.append([None] * len(texts))
+                failed += 1
+        if failed == len(batches):
+            raise RuntimeError(f"None of the {failed} translation batches could be translated")
+        return results
+    
+    return await utils.translate_cached_batches(deployment_name, target_language, texts_per_batch, translate_batches)
+
+
+def write_reconstructed(structure: TextStructure, f: TextIO) -> int:
+    """
+    Reconstruct the text from its structure and write it line by line, without building the complete text in memory.
     
-    return '\n'.join(lines)
+    Args:
+        structure: TextStructure of the text
+        f: Text file opened for writing
+        
+    Returns:
+        Number of characters written
+    """
+    written = 0
+    separator = ''
+    for leading, content, trailing in zip(structure.leading_whitespace,
+                                          structure.contents,
+                                          structure.trailing_whitespace):
+        written += f.write(separator + leading + content + trailing)
+        separator = '\n'
+    return written
 
 
-def translate_txt_document(client: AzureOpenAI, model: str, input_path: str, target_language: str, output_folder: str, save_as_pdf: bool) -> bool:
+def save_text_structure(structure: TextStructure, file_path: str, encoding: str = 'utf-8') -> int:
+    """
+    Write the text reconstructed from its structure to a file.
+    
+    Args:
+        structure: TextStructure of the text
+        file_path: Path of the output file
+        encoding: Encoding of the output file
+        
+    Returns:
+        Number of characters written
+    """
+    with open(file_path, 'w', encoding=encoding, newline='', buffering=OUTPUT_BUFFER_SIZE) as f:
+        return write_reconstructed(structure, f)
+
+
+async def translate_txt_document(client: AsyncAzureOpenAI, model: str, input_path: str, target_language: str, output_folder: str, save_as_pdf: bool, use_batch_api: bool = False) -> bool:
     """
     Translate a text file while preserving formatting.
     
     Args:
-        client: AzureOpenAI client
+        client: AsyncAzureOpenAI client
         model: Azure OpenAI model
         input_path: Path to input .txt file
         target_language: Target language
         output_folder: folder for output file
         save_as_pdf: Indicator to save resulting file as pdf
+        use_batch_api: Indicator to submit all translations as one Batch API job
         
     Returns:
         True if successful, False otherwise
@@ -235,59 +335,61 @@ def translate_txt_document(client: AzureOpenAI, model: str, input_path: str, tar
         file_name = os.path.basename(input_path)
         output_file_path = os.path.join(output_folder, target_language + "_" + file_name)
         
-        # Detect encoding and read file
-        encoding = detect_encoding(input_path)
+        # Read file and detect encoding
+        original_text, encoding = await asyncio.to_thread(read_text_autodetect, input_path)
         print(f"Detected encoding: {encoding}")
         
-        with open(input_path, 'r', encoding=encoding, errors='replace') as f:
-            original_text = f.read()
-        
         print(f"Original text length: {len(original_text)} characters")
         
         # Parse text structure
         print("Analyzing text structure...")
-        structures = parse_text_structure(original_text)
+        structure = parse_text_structure(original_text)
         
         # Group structures for efficient translation
-        translation_batches = group_structures_for_translation(structures)
+        # Tokenize every line once, the counts are used to size the batches
+        tokens_per_struct = [utils.count_tokens(content) for content in structure.contents]
+        translation_batches = group_structures_for_translation(structure, tokens_per_struct)
         print(f"Created {len(translation_batches)} translation batches")
         
-        # Translate each batch
-        for batch_num, (indices, texts) in enumerate(translation_batches):
-            print(f"Translating batch {batch_num + 1}/{len(translation_batches)} ({len(texts)} segments)")
-            
-            translated_texts = translate_text_batch(client, model, texts, target_language)
-            
-            # Apply translations back to structures
+        if use_batch_api:
+            # Translate all batches in one Batch API job
+            results = await translate_batches_with_batch_api(client, model,
+                                                             [texts for _, texts in translation_batches],
+                                                             target_language)
+        else:
+            # Translate all batches concurrently
+            results = await utils.gather_with_concurrency(
+                MAX_CONCURRENT_REQUESTS,
+                *[translate_text_batch(client, model, texts, target_language) for _, texts in translation_batches]
+            )
+        
+            # Texts of a failed batch keep their original content, unless no batch could be translated at all
+            if results and all(translated_texts is None for translated_texts in results):
+                raise RuntimeError(f"None of the {len(results)} translation batches could be translated")
+            results = [texts if translated_texts is None else translated_texts
+                       for (_, texts), translated_texts in zip(translation_batches, results)]
+        
+        # Apply translations back to structures
+        for (indices, _), translated_texts in zip(translation_batches, results):
             for idx, translated_text in zip(indices, translated_texts):
-                if idx < len(structures):
-                    structures[idx]['content'] = translated_text
-            
-            # Small delay between batches to avoid rate limiting
-            if batch_num < len(translation_batches) - 1:
-                time.sleep(0.5)
+                structure.contents[idx] = translated_text
         
-        # Reconstruct the translated text
+        # Reconstruct the translated text and save it to file
         print("Reconstructing translated text...")
-        translated_text = reconstruct_text(structures)
-        
-        # Save translated file
         output_encoding = 'utf-8'  # Always save as UTF-8 for best compatibility
-        with open(output_file_path, 'w', encoding=output_encoding, newline='') as f:
-            f.write(translated_text)
+        translated_length = await asyncio.to_thread(save_text_structure, structure, output_file_path, output_encoding)
         
         # if indicated, save as pdf file
         if save_as_pdf:
             pdf_file_name = os.path.splitext(file_name)[0] + ".pdf"
             pdf_file_path = os.path.join(output_folder, target_language + "_" + pdf_file_name)
-            utils.convert_txt_to_pdf(output_file_path, pdf_file_path)
+            await asyncio.to_thread(utils.convert_txt_to_pdf, output_file_path, pdf_file_path)
             # add watermark to created pdf file
-            watermark_file_path = os.path.abspath(os.path.join(os.getcwd(), "watermark.pdf"))
-            utils.add_watermark(pdf_file_path, pdf_file_path, watermark_file_path)
+            await asyncio.to_thread(utils.watermark_pdf, pdf_file_path, pdf_file_path)
             # remove converted .txt file
             os.remove(output_file_path)
 
-        print(f"Translated text length: {len(translated_text)} characters")
+        print(f"Translated text length: {translated_length} characters")
         return True
         
     except Exception as e:
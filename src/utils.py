@@ -1,64 +1,518 @@
+import asyncio
+import atexit
+import functools
+import io
+import math
+import mmap
 import os
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Preformatted
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-import comtypes.client
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Awaitable, Callable, List, Optional, Tuple, Union
+import tiktoken
+# pypdf, reportlab and comtypes are imported in the functions using them, so they are only loaded when needed
+if TYPE_CHECKING:
+    from openai import AsyncAzureOpenAI
+    from pypdf import PageObject, PdfReader
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, IndirectObject
+    from reportlab.lib.styles import ParagraphStyle
+# local imports
+import settings
+import translation_cache
 
 
-def create_watermark(watermark_text, output_file):
-    c = canvas.Canvas(output_file)
+# Texts that need no translation: combinations of digits and symbols (numbers, dates, times, amounts),
+# urls and e-mail addresses. Single letters are translated, in Chinese or Japanese they can be whole words
+_SKIP_RE = re.compile(r'[\d\W_]+|https?://\S+|\S+@\S+\.\S+')
+# Text of the watermark added to every generated pdf file
+WATERMARK_TEXT = "generated with PBL translator"
+# Cosine (and sine) of the 45 degree rotation of the watermark text
+_COS_45 = math.sqrt(0.5)
+# Resource name of the watermark Form XObject in the resources of the watermarked pages
+WATERMARK_XOBJECT_NAME = "/WmStamp"
+# Buffer size for writing pdf files, so the many small writes of the pdf writers reach the disk in large chunks
+WRITE_BUFFER_SIZE = 1 << 20
+# Maximum number of lines per Preformatted flowable, reportlab lays out very long flowables slowly
+PREFORMATTED_CHUNK_LINES = 500
+# Page margin of converted text files, in points
+PAGE_MARGIN = 36
+# Number of characters above which text files are drawn on a canvas instead of laid out as Preformatted flowables
+CANVAS_TEXT_THRESHOLD = 100_000
+# Maximum number of seconds for converting a single file with LibreOffice
+SOFFICE_TIMEOUT = 300
+# Maximum number of seconds to wait for converting a single file with Word, including the conversions queued before it
+WORD_TIMEOUT = 600
+# Word options that slow down opening and exporting documents, switched off while Word is used for conversion
+_WORD_OPTIONS = ('Pagination', 'CheckGrammarAsYouType', 'CheckSpellingAsYouType')
+# Original options of each Word instance started by _start_word
+_word_options = {}
+# Dedicated thread running all conversions of convert_docx_to_pdf_word, its job queue and its Word instance
+_word_thread = None
+_word_thread_lock = threading.Lock()
+_word_thread_local = threading.local()
+_word_jobs = queue.Queue()
+_word = None
+# Maximum number of input tokens sent to the model in a single API call. Translations can take more tokens than
+# their source text (escaping, longer words, other scripts), so this stays well below MAX_OUTPUT_TOKENS
+MAX_BATCH_TOKENS = 2000
+# Maximum number of tokens of a model response, texts whose translations are cut off are requested again in two halves
+MAX_OUTPUT_TOKENS = getattr(settings, "MAX_OUTPUT_TOKENS", 8000)
+# Tokenizer of the GPT-4o model family
+_ENCODING = tiktoken.encoding_for_model("gpt-4o")
+
+
+def is_translatable(text: str) -> bool:
+    """
+    Check whether a text should be sent to the model for translation.
+    Empty texts, numbers, dates, urls, e-mail addresses and symbols are passed through unchanged.
+
+    Args:
+        text: text to check
+
+    Returns:
+        True if the text should be translated, False otherwise
+    """
+    stripped = text.strip()
+    return bool(stripped) and _SKIP_RE.fullmatch(stripped) is None
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """
+    Count the number of tokens of a text. Results are cached, so repeated texts are tokenized only once.
+
+    Args:
+        text: text to count the tokens of
+
+    Returns:
+        Number of tokens
+    """
+    return len(_ENCODING.encode(text))
+
+
+def pack_by_tokens(texts: List[str], max_tokens: int = 3000, token_counts: Optional[List[int]] = None) -> List[List[str]]:
+    """
+    Split texts into consecutive batches of at most max_tokens tokens each.
+    A single text that exceeds max_tokens is put in a batch of its own.
+
+    Args:
+        texts: texts to split into batches
+        max_tokens: token budget per batch
+        token_counts: precomputed number of tokens of each text, counted if not given
+
+    Returns:
+        List of batches, concatenating the batches gives back texts
+    """
+    if token_counts is None:
+        token_counts = [count_tokens(text) for text in texts]
+    batches = []
+    current_batch = []
+    current_tokens = 0
+    for text, text_tokens in zip(texts, token_counts):
+        if current_batch and current_tokens + text_tokens > max_tokens:
+            batches.append(current_batch)
+            current_batch = []
+            current_tokens = 0
+        current_batch.append(text)
+        current_tokens += text_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+class AsyncRateLimiter:
+    """
+    Token bucket rate limiter for coroutines, allowing bursts of up to max_rate acquisitions
+    and pacing further acquisitions to max_rate per time_period seconds.
+
+    Usage:
+        async with limiter:
+            ...
+    """
+
+    def __init__(self, max_rate: float, time_period: float = 60):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._level = 0.0
+        self._last_check = time.monotonic()
+        self._lock = None
+
+    def _leak(self):
+        # empty the bucket proportionally to the time passed since the last check
+        now = time.monotonic()
+        elapsed = now - self._last_check
+        self._level = max(self._level - elapsed * self.max_rate / self.time_period, 0.0)
+        self._last_check = now
+
+    async def acquire(self):
+        # the lock is created lazily, so it binds to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._leak()
+            while self._level + 1 > self.max_rate:
+                await asyncio.sleep((self._level + 1 - self.max_rate) * self.time_period / self.max_rate)
+                self._leak()
+            self._level += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+
+# Shared limiter for all Azure OpenAI requests, paced to the requests per minute of the deployment.
+# Settings files copied from an older template have no AZURE_RPM, these use the default of the template
+rate_limiter = AsyncRateLimiter(max_rate=getattr(settings, "AZURE_RPM", 60), time_period=60)
+
+
+async def gather_with_concurrency(limit: int, *coroutines):
+    """
+    Run coroutines concurrently while at most limit of them are running at the same time.
+
+    Args:
+        limit: maximum number of coroutines running concurrently
+        coroutines: coroutines to run
+
+    Returns:
+        List of results, in the same order as the coroutines
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def sem_wrap(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(sem_wrap(coroutine) for coroutine in coroutines))
+
+
+async def request_translations(client: "AsyncAzureOpenAI", texts: List[str], build_request: Callable[[List[str]], dict],
+                               parse_response: Callable[[str, int], List[Optional[str]]]) -> List[Optional[str]]:
+    """
+    Send texts to the model in a single API call and parse the translations from the response. A response that is
+    cut off at the maximum number of output tokens is not parsed, the texts are requested again in two halves.
+    A response that can not be parsed is requested once more.
+
+    Args:
+        client: Async Azure OpenAI client
+        texts: texts to translate
+        build_request: function creating the keyword arguments of the chat completion request for a list of texts
+        parse_response: function parsing the translations from the message content of a response, given the number
+            of texts, raises ValueError if the response does not hold a translation for every text
+
+    Returns:
+        List of translations, in the same order as texts, None for a text whose translation is missing
+
+    Raises:
+        ValueError if the translation of a single text does not fit in the output tokens,
+        or the response could not be parsed twice
+    """
+    for attempt in range(2):
+        async with rate_limiter:
+            response = await client.chat.completions.create(**build_request(texts))
+        
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            if len(texts) == 1:
+                raise ValueError(f"Translation exceeds the maximum of {MAX_OUTPUT_TOKENS} output tokens")
+            # the response was cut off, so the translations are requested in two halves
+            half = len(texts) // 2
+            first, second = await asyncio.gather(request_translations(client, texts[:half], build_request, parse_response),
+                                                 request_translations(client, texts[half:], build_request, parse_response))
+            return first + second
+        
+        try:
+            return parse_response(choice.message.content, len(texts))
+        except ValueError as e:
+            if attempt == 1:
+                raise
+            print(f"Invalid response, requesting the translations again: {e}")
+
+
+async def translate_cached_batches(model: str, target_language: str, texts_per_batch: List[List[str]],
+                                   translate_batches: Callable[[List[List[str]]], Awaitable[List[List[Optional[str]]]]]
+                                   ) -> List[List[str]]:
+    """
+    Translate batches of texts. Texts that need no translation keep their original text, and texts that were
+    translated before are taken from the translation cache. Only the remaining texts are passed to translate_batches,
+    and their translations are stored in the cache.
+
+    Args:
+        model: Azure OpenAI deployment name
+        target_language: Target language
+        texts_per_batch: texts of each batch
+        translate_batches: coroutine function translating the remaining texts of the batches that have any, returning
+            for each of these batches a list with the translation of each text, None for a missing translation
+
+    Returns:
+        List of translated texts of each batch, texts without translation keep their original text
+    """
+    # Numbers, urls and symbols have no key, they keep their original text and are not sent to the model
+    keys_per_batch = [[translation_cache.make_key(model, target_language, text) if is_translatable(text) else None
+                       for text in texts] for texts in texts_per_batch]
+    translations = translation_cache.get_many([key for keys in keys_per_batch for key in keys if key is not None])
+    
+    # Only unique texts that are not in the cache yet are sent to the model, batches without such texts are skipped
+    uncached_per_batch = [{key: text for key, text in zip(keys, texts) if key is not None and key not in translations}
+                          for keys, texts in zip(keys_per_batch, texts_per_batch)]
+    uncached_per_batch = [uncached for uncached in uncached_per_batch if uncached]
+    if uncached_per_batch:
+        translated_per_batch = await translate_batches([list(uncached.values()) for uncached in uncached_per_batch])
+        new_translations = {key: translation
+                            for uncached, translated in zip(uncached_per_batch, translated_per_batch)
+                            for key, translation in zip(uncached, translated) if translation is not None}
+        translation_cache.set_many(new_translations)
+        translations.update(new_translations)
+    
+    return [[translations.get(key, text) for key, text in zip(keys, texts)]
+            for keys, texts in zip(keys_per_batch, texts_per_batch)]
+
+
+async def translate_cached(model: str, target_language: str, texts: List[str],
+                           translate: Callable[[List[str]], Awaitable[List[Optional[str]]]]) -> List[str]:
+    """
+    Translate a single batch of texts with translate_cached_batches.
+
+    Args:
+        model: Azure OpenAI deployment name
+        target_language: Target language
+        texts: texts to translate
+        translate: coroutine function translating the texts that are not in the cache
+
+    Returns:
+        List of translated texts, texts without translation keep their original text
+    """
+    async def translate_batches(batches: List[List[str]]) -> List[List[Optional[str]]]:
+        return [await translate(batches[0])]
+    
+    return (await translate_cached_batches(model, target_language, [texts], translate_batches))[0]
+
+
+@functools.lru_cache(maxsize=32)
+def create_watermark(watermark_text: str) -> bytes:
+    """
+    Create a single page pdf with the watermark text, rotated by 45 degrees. The pdf is created in memory,
+    once per watermark text.
+
+    Args:
+        watermark_text: text of the watermark
+
+    Returns:
+        Content of the pdf file
+    """
+    from reportlab.pdfgen import canvas
+
+    watermark_pdf = io.BytesIO()
+    c = canvas.Canvas(watermark_pdf)
     c.setFont("Helvetica", 40) # Font type and font size
     c.setFillColorRGB(0.5, 0.5, 0.5, 0.4)  # Set watermark color (RGB) and transparency
-    c.saveState()
-    c.translate(100, 200)  # Move the origin to a better position for rotation
-    c.rotate(45)  # Rotate the text by 45 degrees
+    # Move the origin to a better position and rotate the text by 45 degrees, in a single transformation
+    c.transform(_COS_45, _COS_45, -_COS_45, _COS_45, 100, 200)
     c.drawString(0, 0, watermark_text)  # Draw text at the new origin
-    c.restoreState()
     c.save()
+    return watermark_pdf.getvalue()
 
 
-def add_watermark(input_pdf_path, output_pdf_path, watermark_pdf_path):
-    # Read the watermark PDF
-    watermark_pdf = PdfReader(watermark_pdf_path)
-    watermark_page = watermark_pdf.pages[0]
+def write_file_atomic(file_path: str, write: Callable[[IO], object], estimated_size: int = 0):
+    """
+    Write a file through a temporary file that replaces the file when writing succeeded, so an interrupted
+    write never leaves a corrupt file behind. Where supported, the estimated size is allocated up front,
+    so the file is stored contiguously instead of growing with every write.
 
-    # Read the input PDF
-    input_pdf = PdfReader(input_pdf_path)
-    writer = PdfWriter()
+    Args:
+        file_path: path of the file
+        write: function writing the content to the binary file object it is called with
+        estimated_size: expected size of the file in bytes, 0 if unknown
+    """
+    tmp_path = file_path + ".tmp"
+    try:
+        with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as file:
+            if estimated_size > 0 and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(file.fileno(), 0, estimated_size)
+            write(file)
+            # remove the part of the allocated space that was not written
+            file.truncate()
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    # Add watermark to each page
-    for page in input_pdf.pages:
-        page.merge_page(watermark_page)
-        writer.add_page(page)
 
-    # Write the output PDF
-    with open(output_pdf_path, "wb") as output_pdf_file:
-        writer.write(output_pdf_file)
+def _add_form_xobject(writer, page: "PageObject") -> "IndirectObject":
+    """
+    Register a page with a writer as a Form XObject, which other pages can draw by reference with the Do operator.
+    The content of the page is stored once, with its own resources, instead of being copied into every page.
 
+    Args:
+        writer: pdf writer to register the Form XObject with
+        page: page to convert
 
-def convert_txt_to_pdf(txt_file_path: str, pdf_file_path: str, font_size=10):
+    Returns:
+        Reference to the Form XObject
     """
-    Convert a text file to PDF while preserving original formatting.
-    
+    from pypdf.generic import NameObject
+
+    form = _content_stream(page.get_contents().get_data())
+    form.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): page.mediabox.clone(writer),
+        NameObject("/Resources"): page[NameObject("/Resources")].clone(writer),
+    })
+    return writer._add_object(form.flate_encode())
+
+
+def _content_stream(data: bytes) -> "DecodedStreamObject":
+    """
+    Create a content stream with the given content.
+    """
+    from pypdf.generic import DecodedStreamObject
+
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return stream
+
+
+def _overlay_contents(page: "PageObject", contents: List["IndirectObject"], resources: "DictionaryObject",
+                      push: "IndirectObject", pop: "IndirectObject") -> bool:
+    """
+    Draw content streams on top of a page, by adding them to the /Contents array of the page and adding
+    their resources to the page resources, without parsing the content of the page. The content of the page
+    is wrapped in push and pop (q and Q operators), so its graphics state does not affect the overlay.
+
     Args:
-        txt_file_path (str): Path to the input .txt file
-        pdf_file_path (str): Path to the output .pdf file
-        font_size (int): Font size for the text (default: 10)
+        page: page to draw on
+        contents: references to the content streams to draw, registered with the writer of the page
+        resources: resources used by the content streams, registered with the writer of the page
+        push: reference to a content stream saving the graphics state
+        pop: reference to a content stream restoring the graphics state
+
+    Returns:
+        True if successful, False without changing the page if a resource name is already used by the page
+        for another resource
     """
-    # Create a PDF document
-    doc = SimpleDocTemplate(pdf_file_path, pagesize=letter,
-                            rightMargin=36, leftMargin=36,
-                            topMargin=36, bottomMargin=36)
+    from pypdf.generic import ArrayObject, DictionaryObject, NameObject
+
+    page_resources = page.get(NameObject("/Resources"))
+    page_resources = page_resources.get_object() if page_resources is not None else DictionaryObject()
+    for category, entries in resources.items():
+        page_entries = page_resources.get(category)
+        page_entries = page_entries.get_object() if page_entries is not None else None
+        entries = entries.get_object()
+        if isinstance(page_entries, DictionaryObject) and isinstance(entries, DictionaryObject) and any(
+                page_entries.get(name, value) != value for name, value in entries.items()):
+            return False
     
-    # Get default styles
-    styles = getSampleStyleSheet()
+    for category, entries in resources.items():
+        entries = entries.get_object()
+        page_entries = page_resources.get(category)
+        if page_entries is None:
+            page_resources[NameObject(category)] = DictionaryObject(entries) if isinstance(entries, DictionaryObject) else entries
+        elif isinstance(entries, DictionaryObject):
+            page_entries.get_object().update(entries)
+    page[NameObject("/Resources")] = page_resources
     
-    # Create a monospace style that preserves formatting
-    preformatted_style = ParagraphStyle(
+    page_contents = page.get(NameObject("/Contents"))
+    if page_contents is None:
+        page_contents = []
+    elif isinstance(page_contents.get_object(), ArrayObject):
+        page_contents = list(page_contents.get_object())
+    else:
+        page_contents = [page_contents]
+    page[NameObject("/Contents")] = ArrayObject([push, *page_contents, pop, *contents])
+    return True
+
+
+@functools.lru_cache(maxsize=32)
+def _get_watermark_page(watermark_text: str) -> "PageObject":
+    """
+    Create the watermark page for a watermark text in memory. The page is created and parsed once per text
+    and kept in memory, so it can be reused for all files in a translation batch. The page is copied into
+    a writer of its own, so all its objects are read up front: a reader reads objects lazily from its stream,
+    which is not safe when several files are watermarked at the same time.
+
+    Args:
+        watermark_text: text of the watermark
+
+    Returns:
+        Watermark page
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    return PdfWriter().add_page(PdfReader(io.BytesIO(create_watermark(watermark_text))).pages[0])
+
+
+def watermark_pdf(input_pdf: Union[str, IO, "PdfReader"], output_pdf_path: str, watermark=WATERMARK_TEXT):
+    """
+    Add a watermark to every page of a PDF file. The watermark is created in memory, so the only file
+    written is the output file.
+
+    Args:
+        input_pdf: file path or file object of the pdf file to watermark, or an already parsed pdf file
+        output_pdf_path: file path of the watermarked pdf file
+        watermark: text of the watermark, or an already created watermark page
+    """
+    from pypdf import PdfWriter
+    from pypdf.generic import DictionaryObject, NameObject
+
+    watermark_page = _get_watermark_page(watermark) if isinstance(watermark, str) else watermark
+
+    # Clone the input PDF into the writer, so its pages do not have to be copied one by one. A file is memory mapped,
+    # so it is read through the page cache instead of by many small reads. Cloning reads the whole file, so the map
+    # is closed before the output is written, which may replace the input file
+    if isinstance(input_pdf, str):
+        with open(input_pdf, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_pdf:
+            if hasattr(mmap, "MADV_WILLNEED"):
+                mapped_pdf.madvise(mmap.MADV_WILLNEED)
+            input_size = len(mapped_pdf)
+            writer = PdfWriter(clone_from=mapped_pdf)
+    else:
+        input_size = input_pdf.getbuffer().nbytes if isinstance(input_pdf, io.BytesIO) else 0
+        writer = PdfWriter(clone_from=input_pdf)
+
+    # Register the watermark with the writer once as a Form XObject, every page draws it with a one line
+    # content stream, shared by all pages as well
+    stamp = _add_form_xobject(writer, watermark_page)
+    stamp_resources = DictionaryObject({NameObject("/XObject"): DictionaryObject({
+        NameObject(WATERMARK_XOBJECT_NAME): stamp})})
+    draw_stamp = writer._add_object(_content_stream(f"q {WATERMARK_XOBJECT_NAME} Do Q\n".encode()))
+    push = writer._add_object(_content_stream(b"q\n"))
+    pop = writer._add_object(_content_stream(b"\nQ\n"))
+
+    # Add watermark to each page
+    for page in writer.pages:
+        if not _overlay_contents(page, [draw_stamp], stamp_resources, push, pop):
+            # the name of the watermark XObject is already used by the page, merging renames the watermark resources
+            page.merge_page(watermark_page)
+
+    # Write the output PDF, each page grows by a few references to the watermark streams
+    write_file_atomic(output_pdf_path, writer.write, input_size + 64 * len(writer.pages) if input_size else 0)
+
+
+@functools.lru_cache(maxsize=8)
+def get_preformatted_style(font_size: int) -> "ParagraphStyle":
+    """
+    Create the monospace style that preserves formatting. Styles are created once per font size.
+
+    Args:
+        font_size: font size of the text
+
+    Returns:
+        Paragraph style
+    """
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+    return ParagraphStyle(
         'PreformattedText',
-        parent=styles['Code'],
+        parent=getSampleStyleSheet()['Code'],
         fontName='Courier',  # Monospace font
         fontSize=font_size,
         leftIndent=0,
@@ -67,11 +521,85 @@ def convert_txt_to_pdf(txt_file_path: str, pdf_file_path: str, font_size=10):
         spaceBefore=0,
         wordWrap='LTR',  # Left to right, preserve spacing
     )
+
+
+def build_preformatted_story(content: str, style: "ParagraphStyle", max_lines: int = PREFORMATTED_CHUNK_LINES) -> list:
+    """
+    Split a text into Preformatted flowables of at most max_lines lines, which preserve whitespace and formatting.
+    Preformatted drops blank lines at the start and end of its text, so these are added as spacers of one line each,
+    a single spacer for many lines could be higher than a page.
+
+    Args:
+        content: text to layout
+        style: paragraph style of the text
+        max_lines: maximum number of lines per flowable
+
+    Returns:
+        List of flowables
+    """
+    from reportlab.platypus import Preformatted, Spacer
+
+    lines = content.split('\n')
+    story = []
+    for start in range(0, len(lines), max_lines):
+        chunk = lines[start:start + max_lines]
+        non_blank = [i for i, line in enumerate(chunk) if line.strip()]
+        if not non_blank:
+            story.extend(Spacer(0, style.leading) for _ in chunk)
+            continue
+        first, last = non_blank[0], non_blank[-1]
+        story.extend(Spacer(0, style.leading) for _ in range(first))
+        story.append(Preformatted('\n'.join(chunk[first:last + 1]), style))
+        story.extend(Spacer(0, style.leading) for _ in range(len(chunk) - 1 - last))
+    return story
+
+
+def draw_text_pages(content: str, output, style: "ParagraphStyle"):
+    """
+    Draw a text line by line on letter pages with a reportlab canvas, preserving whitespace. Unlike the
+    Preformatted flowable, the time needed grows linearly with the length of the text.
+
+    Args:
+        content: text to draw
+        output: file path or file object of the pdf file
+        style: paragraph style of the text, only its font name, font size and leading are used
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    _, page_height = letter
+    lines_per_page = max(1, int((page_height - 2 * PAGE_MARGIN) // style.leading))
+    lines = content.split('\n')
+    c = canvas.Canvas(output, pagesize=letter)
+    for start in range(0, len(lines), lines_per_page):
+        text = c.beginText(PAGE_MARGIN, page_height - PAGE_MARGIN - style.fontSize)
+        text.setFont(style.fontName, style.fontSize, style.leading)
+        for line in lines[start:start + lines_per_page]:
+            text.textLine(line)
+        c.drawText(text)
+        c.showPage()
+    c.save()
+
+
+def convert_txt_to_pdf(txt_file_path: str, pdf_file_path: str, font_size=10):
+    """
+    Convert a text file to PDF while preserving original formatting.
+    
+    Args:
+        txt_file_path (str): Path to the input .txt file
+        pdf_file_path (str): Path to the output .pdf file
+        font_size (int): Font size for the text (default: 10)
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate
+
+    # Monospace style that preserves formatting
+    preformatted_style = get_preformatted_style(font_size)
     
-    # Read the text file
+    # Read the text file in one go and decode it once
     try:
-        with open(txt_file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
+        with open(txt_file_path, 'rb', buffering=0) as file:
+            data = file.read()
     except FileNotFoundError:
         print(f"Error: File '{txt_file_path}' not found.")
         return False
@@ -79,16 +607,25 @@ def convert_txt_to_pdf(txt_file_path: str, pdf_file_path: str, font_size=10):
         print(f"Error reading file: {e}")
         return False
     
-    # Create story with preformatted text
-    story = []
-    
-    # Use Preformatted flowable which preserves whitespace and formatting
-    preformatted_text = Preformatted(content, preformatted_style)
-    story.append(preformatted_text)
+    # Pure ASCII text is decoded with the simpler latin-1 codec, other text as utf-8 replacing invalid bytes
+    content = data.decode('latin-1') if data.isascii() else data.decode('utf-8', errors='replace')
+    # Normalize Windows line endings once, so no carriage returns reach the layout
+    content = content.replace('\r\n', '\n')
     
-    # Build the PDF
+    # Build the PDF in memory, it is written to file at once after building
+    pdf_buffer = io.BytesIO()
     try:
-        doc.build(story)
+        if len(content) > CANVAS_TEXT_THRESHOLD:
+            # Huge texts are drawn directly on the pages, skipping the layout engine
+            draw_text_pages(content, pdf_buffer, preformatted_style)
+        else:
+            doc = SimpleDocTemplate(pdf_buffer, pagesize=letter,
+                                    rightMargin=PAGE_MARGIN, leftMargin=PAGE_MARGIN,
+                                    topMargin=PAGE_MARGIN, bottomMargin=PAGE_MARGIN)
+            # Create story with preformatted text, split over multiple flowables to keep the layout of long texts fast
+            doc.build(build_preformatted_story(content, preformatted_style))
+        pdf_data = pdf_buffer.getbuffer()
+        write_file_atomic(pdf_file_path, lambda pdf_file: pdf_file.write(pdf_data), pdf_data.nbytes)
         print(f"PDF successfully created: {pdf_file_path}")
         return True
     except Exception as e:
@@ -96,7 +633,223 @@ def convert_txt_to_pdf(txt_file_path: str, pdf_file_path: str, font_size=10):
         return False
 
 
-def convert_docx_to_pdf(docx_file: str, pdf_file: str) -> bool:
+def _start_word():
+    """
+    Start an invisible Word instance, with background repagination and spelling and grammar checks switched off.
+    These options are stored in the Word settings of the user, so their original values are kept on the instance
+    and restored by _quit_word.
+
+    Returns:
+        Word application COM object
+    """
+    import comtypes.client
+
+    word = comtypes.client.CreateObject('Word.Application')
+    word.Visible = False  # Don't show Word window
+    word.ScreenUpdating = False
+    word_options = {name: getattr(word.Options, name) for name in _WORD_OPTIONS}
+    for name in _WORD_OPTIONS:
+        setattr(word.Options, name, False)
+    _word_options[id(word)] = word_options
+    return word
+
+
+def _quit_word(word):
+    """
+    Restore the Word options changed by _start_word and close Word.
+
+    Args:
+        word: Word application COM object
+    """
+    try:
+        for name, value in _word_options.pop(id(word), {}).items():
+            setattr(word.Options, name, value)
+    finally:
+        word.Quit()
+
+
+def _export_pdf(word, docx_file: str, pdf_file: str, high_quality: bool = True) -> bool:
+    """
+    Open a DOCX file in Word and export it to PDF.
+
+    Args:
+        word: Word application COM object
+        docx_file: file path of docx file
+        pdf_file: file path of pdf file
+        high_quality: export with print layout fidelity, otherwise save as PDF with the faster SaveAs2
+
+    Returns:
+        True if successful, False otherwise
+    """
+    # Convert to absolute paths
+    docx_path = os.path.abspath(docx_file)
+    pdf_path = os.path.abspath(pdf_file)
+    
+    # Open the document
+    doc = word.Documents.Open(docx_path)
+    
+    try:
+        if high_quality:
+            # Export as PDF with high quality settings
+            doc.ExportAsFixedFormat(
+                OutputFileName=pdf_path,
+                ExportFormat=17,  # PDF format
+                OpenAfterExport=False,
+                OptimizeFor=0,  # Optimize for print (better quality)
+                Range=0,  # Export the entire document
+                Item=0,  # Export the document content without markup
+                IncludeDocProps=False,
+                KeepIRM=False,
+                CreateBookmarks=0,  # 0 for None, 1 for Headings
+                DocStructureTags=False,  # Skip the accessibility structure tags
+                BitmapMissingFonts=True  # Bitmap text of fonts that can not be embedded, instead of substituting them
+            )
+        else:
+            doc.SaveAs2(FileName=pdf_path, FileFormat=17)  # PDF format
+    finally:
+        # Close document without saving, Word stays open for the next document
+        doc.Close(SaveChanges=0)
+    
+    # Verify conversion
+    if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
+        print(f"✓ Perfect conversion completed: {pdf_file}")
+        return True
+    else:
+        print("✗ PDF conversion failed")
+        return False
+
+
+class WordConverter:
+    """
+    Convert DOCX files to PDF with the Word instance of the Word thread, which is started when entering the context
+    and closed when leaving it:
+
+        with WordConverter() as converter:
+            for docx_file, pdf_file in files:
+                converter.convert(docx_file, pdf_file)
+    """
+
+    def __enter__(self):
+        _run_on_word_thread(_get_word).result(timeout=WORD_TIMEOUT)
+        return self
+
+    def convert(self, docx_file: str, pdf_file: str, high_quality: bool = True) -> bool:
+        """
+        Convert a DOCX file to PDF.
+
+        Args:
+            docx_file: file path of docx file
+            pdf_file: file path of pdf file
+            high_quality: export with print layout fidelity, otherwise save as PDF with the faster SaveAs2
+
+        Returns:
+            True if successful, False otherwise
+        """
+        return convert_docx_to_pdf_word(docx_file, pdf_file, high_quality)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            _run_on_word_thread(_close_word).result(timeout=WORD_TIMEOUT)
+        except Exception:
+            pass
+
+
+def _get_word():
+    """
+    Get the Word instance of the Word thread, Word is started on first use and kept open for the next conversions.
+
+    Returns:
+        Word application COM object
+    """
+    global _word
+    if _word is None:
+        _word = _start_word()
+    return _word
+
+
+def _close_word():
+    """
+    Close the Word instance of the Word thread, if it is running.
+    """
+    global _word
+    word, _word = _word, None
+    if word is not None:
+        try:
+            _quit_word(word)
+        except Exception:
+            pass
+
+
+def _word_worker(started: Future):
+    """
+    Run the jobs of the Word job queue until it receives None. COM is initialized once for this thread,
+    and the Word instance is only used from this thread, as COM objects are bound to the thread that created them.
+
+    Args:
+        started: future set when COM is initialized, or set to the error if COM could not be initialized
+    """
+    try:
+        import comtypes
+        comtypes.CoInitializeEx(comtypes.COINIT_APARTMENTTHREADED)
+    except BaseException as e:
+        started.set_exception(e)
+        return
+    _word_thread_local.is_word_thread = True
+    started.set_result(None)
+    try:
+        while (job := _word_jobs.get()) is not None:
+            function, args, future = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+    finally:
+        _close_word()
+        comtypes.CoUninitialize()
+
+
+def _run_on_word_thread(function: Callable, *args) -> Future:
+    """
+    Run a function on the Word thread, the thread is started on first use and started again if it has stopped.
+
+    Args:
+        function: function to run
+        args: arguments of the function
+
+    Returns:
+        Future with the result of the function
+
+    Raises:
+        the error of initializing COM on the Word thread (e.g. comtypes is not installed), no job is queued then
+    """
+    global _word_thread
+    with _word_thread_lock:
+        if _word_thread is None or not _word_thread.is_alive():
+            started = Future()
+            thread = threading.Thread(target=_word_worker, args=(started,), name="word", daemon=True)
+            thread.start()
+            # wait until the thread runs its job loop, so jobs are never queued for a thread that has stopped
+            started.result()
+            _word_thread = thread
+    future = Future()
+    _word_jobs.put((function, args, future))
+    return future
+
+
+def _stop_word_thread():
+    """
+    Let the Word thread close Word and uninitialize COM, registered to run at interpreter exit.
+    """
+    if _word_thread is not None and _word_thread.is_alive():
+        _word_jobs.put(None)
+        _word_thread.join(timeout=60)
+
+
+atexit.register(_stop_word_thread)
+
+
+def convert_docx_to_pdf_word(docx_file: str, pdf_file: str, high_quality: bool = True) -> bool:
     """
     Convert DOCX to PDF using Microsoft Word COM interface.
     This method preserves ALL formatting perfectly including:
@@ -105,60 +858,127 @@ def convert_docx_to_pdf(docx_file: str, pdf_file: str) -> bool:
     - Fonts, styles, colors
     - Page breaks, margins
     - Embedded objects
+    Conversions run one at a time on a dedicated thread, which keeps COM initialized and Word open
+    for the next conversions. Can be called from any thread.
 
     Args:
         docx_file: file path of docx file
         pdf_file: file path of pdf file
+        high_quality: export with print layout fidelity, otherwise save as PDF with the faster SaveAs2
 
     Returns:
         True if successful, False otherwise
 
     """
-    comtypes.CoInitialize()
-
-    try:
-        # Create Word application object
-        word = comtypes.client.CreateObject('Word.Application')
-        word.Visible = False  # Don't show Word window
-        
-        # Convert to absolute paths
-        docx_path = os.path.abspath(docx_file)
-        pdf_path = os.path.abspath(pdf_file)
-        
-        # Open the document
-        doc = word.Documents.Open(docx_path)
-        
-        # Export as PDF with high quality settings
-        doc.ExportAsFixedFormat(
-            OutputFileName=pdf_path,
-            ExportFormat=17,  # PDF format
-            OpenAfterExport=False,
-            OptimizeFor=0,  # Optimize for print (better quality)
-            CreateBookmarks=0  # 0 for None, 1 for Headings
-        )
-        
-        # Close document and Word
-        doc.Close()
-        word.Quit()
-        
-        # Verify conversion
-        if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
-            print(f"✓ Perfect conversion completed: {pdf_file}")
-            return True
-        else:
-            print("✗ PDF conversion failed")
+    if not getattr(_word_thread_local, 'is_word_thread', False):
+        try:
+            return _run_on_word_thread(convert_docx_to_pdf_word, docx_file, pdf_file, high_quality).result(
+                timeout=WORD_TIMEOUT)
+        except Exception as e:
+            print(f"✗ Error with Word COM: {e}")
             return False
+    
+    try:
+        return _export_pdf(_get_word(), docx_file, pdf_file, high_quality)
             
     except Exception as e:
         print(f"✗ Error with Word COM: {e}")
-        # Try to cleanup Word process
-        try:
-            if 'word' in locals():
-                word.Quit()
-        except:
-            pass
+        # Word may have crashed or been closed, so it is started again on the next conversion
+        _close_word()
+        return False
+
+
+def _soffice_convert(soffice: str, docx_file: str, pdf_file: str, profile_dir: str) -> bool:
+    """
+    Convert a DOCX file to PDF with headless LibreOffice.
+
+    Args:
+        soffice: path of the soffice executable
+        docx_file: file path of docx file
+        pdf_file: file path of pdf file
+        profile_dir: LibreOffice user profile directory, concurrent conversions need separate profiles
+
+    Returns:
+        True if successful, False otherwise
+    """
+    pdf_path = os.path.abspath(pdf_file)
+    out_dir = os.path.dirname(pdf_path)
+    try:
+        subprocess.run([soffice, f"-env:UserInstallation={Path(profile_dir).as_uri()}", "--headless",
+                        "--convert-to", "pdf", "--outdir", out_dir, os.path.abspath(docx_file)],
+                       check=True, capture_output=True, timeout=SOFFICE_TIMEOUT)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"✗ Error with LibreOffice: {e}")
         return False
     
-    finally:
-        # Always uninitialize COM
-        comtypes.CoUninitialize()
+    # LibreOffice names the pdf file after the docx file
+    converted_path = os.path.join(out_dir, os.path.splitext(os.path.basename(docx_file))[0] + ".pdf")
+    if converted_path != pdf_path and os.path.exists(converted_path):
+        os.replace(converted_path, pdf_path)
+    
+    # Verify conversion
+    if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
+        print(f"✓ Conversion completed: {pdf_file}")
+        return True
+    else:
+        print("✗ PDF conversion failed")
+        return False
+
+
+def convert_docx_to_pdf(docx_file: str, pdf_file: str, high_quality: bool = True) -> bool:
+    """
+    Convert DOCX to PDF with headless LibreOffice if it is installed, otherwise or if LibreOffice fails
+    with the Microsoft Word COM interface. Can be called from any thread.
+
+    Args:
+        docx_file: file path of docx file
+        pdf_file: file path of pdf file
+        high_quality: for Word, export with print layout fidelity, otherwise save as PDF with the faster SaveAs2
+
+    Returns:
+        True if successful, False otherwise
+    """
+    soffice = shutil.which("soffice")
+    if soffice is not None:
+        # every conversion uses its own user profile, so concurrent conversions do not contend for the profile lock
+        with tempfile.TemporaryDirectory() as profile_dir:
+            if _soffice_convert(soffice, docx_file, pdf_file, profile_dir):
+                return True
+    return convert_docx_to_pdf_word(docx_file, pdf_file, high_quality)
+
+
+def convert_docx_to_pdf_batch(pairs: List[Tuple[str, str]], workers: Optional[int] = None) -> List[bool]:
+    """
+    Convert multiple DOCX files to PDF in parallel with a pool of headless LibreOffice processes.
+    If LibreOffice is not installed, the files are converted one by one with the Word instance of the Word thread.
+
+    Args:
+        pairs: list of (docx file path, pdf file path) tuples
+        workers: number of parallel conversions, defaults to the number of CPUs
+
+    Returns:
+        List with for each pair True if successful, False otherwise
+    """
+    if not pairs:
+        return []
+    
+    soffice = shutil.which("soffice")
+    if soffice is None:
+        return [convert_docx_to_pdf_word(docx_file, pdf_file) for docx_file, pdf_file in pairs]
+    
+    workers = min(workers or os.cpu_count() or 1, len(pairs))
+    with tempfile.TemporaryDirectory() as profiles_root:
+        # every worker uses its own user profile, to avoid contention on the profile lock file
+        profiles = queue.Queue()
+        for i in range(workers):
+            profiles.put(os.path.join(profiles_root, f"worker{i}"))
+        
+        def convert(pair: Tuple[str, str]) -> bool:
+            profile_dir = profiles.get()
+            try:
+                return _soffice_convert(soffice, pair[0], pair[1], profile_dir)
+            finally:
+                profiles.put(profile_dir)
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(convert, pairs))